@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+
+"""
+
+    Offline benchmarks for uploadr.py, run against the local mock Flickr
+    server (mockflickr.py) on a synthetic media tree (maketree.py).
+
+    Scenarios, each run in its own process so peak RSS is per scenario:
+
+    -grabNewFiles, md5Checksum, encode_multipart_formdata: the local work alone
+    -cold-start: empty database, everything gets uploaded, sets and tags created
+    -steady-state: second run over the same tree, nothing changed
+    -backfill: new files added to an already synced tree
+
+    Every scenario reports files/s, MB/s, API calls/s and peak RSS. The tree
+    and the mock's error pattern come from --seed, so runs are reproducible.
+
+    Usage:
+
+    $ ./bench.py --files 2000 --scale 0.05 --latency 0.05 --json results.json
+
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert( 0, os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) ) )
+
+import maketree
+import mockflickr
+
+PHASES = [ "removeUselessSetsTable", "getFlickrSets", "upload", "removeDeletedMedia", "createSets", "addTagsToUploadedPhotos" ]
+
+def setupUploadr( workdir, base, options ):
+    """ Import uploadr and point it at the mock server and the benchmark tree
+    """
+    sys.stdout = open( os.devnull, "w" )
+    import uploadr
+    uploadr.FILES_DIR = os.path.join( workdir, "media" )
+    uploadr.DB_PATH = os.path.join( workdir, "fickerdb" )
+    uploadr.METRICS_FILE = ""
+    uploadr.RUN_SUMMARY_FILE = ""
+    uploadr.FLICKR[ "api_key" ] = "bench"
+    uploadr.FLICKR[ "secret" ] = "bench"
+    uploadr.API_CALLS_PER_HOUR = options.rate
+    uploadr.Uploadr.TOKEN_FILE = os.path.join( workdir, "flickrToken" )
+    uploadr.api.base = base
+    uploadr.api.rest = base + "rest/"
+    uploadr.api.auth = base + "auth/"
+    uploadr.api.upload = base + "upload/"
+    uploadr.api.replace = base + "replace/"
+    uploadr.args = argparse.Namespace( daemon = False, title = None, description = None, tags = None,
+        drip_feed = False, order = None, force_delete = True )
+    with open( uploadr.Uploadr.TOKEN_FILE, "w" ) as f:
+        f.write( "mock-token" )
+    return uploadr
+
+def runScenario( name, workdir, base, options, results ):
+    """ Child process: run one scenario, put (files, local bytes, peak RSS in kB) on results
+    """
+    uploadr = setupUploadr( workdir, base, options )
+    flick = uploadr.Uploadr()
+    flick.setupDB()
+    files = 0
+    localBytes = 0
+    if ( name == "grabNewFiles" ):
+        files = len( flick.grabNewFiles() )
+    elif ( name == "md5Checksum" ):
+        for path, size, mtime in flick.scanFiles():
+            flick.md5Checksum( path )
+            files += 1
+            localBytes += size
+    elif ( name == "encode_multipart_formdata" ):
+        for path, size, mtime in flick.scanFiles():
+            with open( path, "rb" ) as f:
+                flick.encode_multipart_formdata( { "title" : "bench" }, [ ( "photo", path, f.read() ) ] )
+            files += 1
+            localBytes += size
+    else:
+        flick.checkToken()
+        for phase in PHASES:
+            flick.runPhase( phase, exclusive = False )
+        files = len( flick.grabNewFiles() )
+    flick.leases.releaseAll()
+    results.put( ( files, localBytes, resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss ) )
+
+def measure( name, workdir, base, mock, options ):
+    """ Run a scenario in a fresh process and work out the rates
+    """
+    calls = sum( mock.calls.values() )
+    sent = mock.bytes
+    results = multiprocessing.Queue()
+    start = time.time()
+    child = multiprocessing.Process( target = runScenario, args = ( name, workdir, base, options, results ) )
+    child.start()
+    files, localBytes, rss = results.get()
+    child.join()
+    seconds = time.time() - start
+    calls = sum( mock.calls.values() ) - calls
+    transferred = ( mock.bytes - sent ) or localBytes
+    return {
+        "scenario"      : name,
+        "seconds"       : seconds,
+        "files"         : files,
+        "files_per_s"   : files / seconds,
+        "mb_per_s"      : transferred / 1e6 / seconds,
+        "api_calls"     : calls,
+        "api_calls_per_s" : calls / seconds,
+        "peak_rss_mb"   : rss / 1024.0
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser( description = 'Offline benchmarks for uploadr.py.' )
+    parser.add_argument( '-n', '--files', type = int, default = 500,
+        help = 'Files in the synthetic tree (default: %(default)s)' )
+    parser.add_argument( '-f', '--folders', type = int, default = 20,
+        help = 'Folders in the synthetic tree (default: %(default)s)' )
+    parser.add_argument( '-x', '--scale', type = float, default = 0.02,
+        help = 'Multiply file sizes by this (default: %(default)s)' )
+    parser.add_argument( '-b', '--backfill', type = int, default = 100,
+        help = 'Files added for the backfill scenario (default: %(default)s)' )
+    parser.add_argument( '-s', '--seed', type = int, default = 0,
+        help = 'Random seed for tree and errors (default: %(default)s)' )
+    parser.add_argument( '-l', '--latency', type = float, default = 0.0,
+        help = 'Mock server latency per request in seconds' )
+    parser.add_argument( '-w', '--bandwidth', type = int, default = None,
+        help = 'Mock server upload bandwidth in bytes per second (default: unlimited)' )
+    parser.add_argument( '-e', '--error-rate', type = float, default = 0.0,
+        help = 'Share of mock requests answered with a 500' )
+    parser.add_argument( '-r', '--rate', type = int, default = 0,
+        help = 'API_CALLS_PER_HOUR for uploadr (default: unlimited)' )
+    parser.add_argument( '-d', '--workdir', action = 'store',
+        help = 'Directory for the tree and database (default: a temporary one, removed afterwards)' )
+    parser.add_argument( '-j', '--json', action = 'store',
+        help = 'Also write the results to this file' )
+    options = parser.parse_args()
+
+    workdir = options.workdir or tempfile.mkdtemp( prefix = "uploadr-bench-" )
+    media = os.path.join( workdir, "media" )
+    try:
+        mock = mockflickr.MockFlickr( options.latency, options.bandwidth, options.error_rate, options.seed )
+        server, base = mockflickr.start( mock )
+        maketree.makeTree( media, options.files, options.folders, options.seed, options.scale )
+
+        rows = []
+        for name in ( "grabNewFiles", "md5Checksum", "encode_multipart_formdata", "cold-start", "steady-state" ):
+            rows.append( measure( name, workdir, base, mock, options ) )
+        maketree.makeTree( os.path.join( media, "backfill" ), options.backfill, max( 1, options.folders / 10 ), options.seed + 1, options.scale )
+        rows.append( measure( "backfill", workdir, base, mock, options ) )
+        server.shutdown()
+
+        print("%-26s %8s %7s %9s %8s %10s %9s" % ( "scenario", "seconds", "files", "files/s", "MB/s", "API calls/s", "RSS MB" ))
+        for row in rows:
+            print("%-26s %8.2f %7d %9.1f %8.2f %10.1f %9.1f" % ( row[ "scenario" ], row[ "seconds" ], row[ "files" ],
+                row[ "files_per_s" ], row[ "mb_per_s" ], row[ "api_calls_per_s" ], row[ "peak_rss_mb" ] ))
+        if ( options.json ):
+            with open( options.json, "w" ) as f:
+                json.dump( { "options" : vars( options ), "results" : rows }, f, indent = 2, sort_keys = True )
+    finally:
+        if ( not options.workdir ):
+            shutil.rmtree( workdir, True )
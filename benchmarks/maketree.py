@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+"""
+
+    Generate a synthetic media tree for benchmarks: year/event folders
+    with photos and a few videos of random content, sizes and dates.
+    The same seed always gives the same tree.
+
+    Usage:
+
+    $ ./maketree.py /tmp/media --files 2000 --folders 50 --seed 1
+
+"""
+import argparse
+import os
+import random
+import time
+
+# (extension, share of the files, min size, max size)
+KINDS = [
+    ( "jpg", 0.85, 200000, 6000000 ),
+    ( "png", 0.05, 50000, 2000000 ),
+    ( "mov", 0.05, 5000000, 45000000 ),
+    ( "mp4", 0.05, 2000000, 30000000 )
+]
+
+def makeTree( root, files = 1000, folders = 20, seed = 0, scale = 1.0, startYear = 1999, endYear = 2026 ):
+    """ Write files spread over folders below root. Sizes are multiplied by
+    scale (use something like 0.01 to keep test trees small).
+    Returns (number of files, total bytes)
+    """
+    rnd = random.Random( seed )
+    dirs = []
+    for i in range( folders ):
+        year = rnd.randint( startYear, endYear )
+        dirs.append( ( os.path.join( root, str( year ), "%s-event-%03d" % ( year, i ) ), year ) )
+    block = "".join( chr( rnd.randint( 0, 255 ) ) for i in range( 65536 ) )
+    total = 0
+    for i in range( files ):
+        path, year = rnd.choice( dirs )
+        pick = rnd.random()
+        for ext, share, low, high in KINDS:
+            pick -= share
+            if ( pick <= 0 ):
+                break
+        size = max( 1, int( rnd.randint( low, high ) * scale ) )
+        if ( not os.path.isdir( path ) ):
+            os.makedirs( path )
+        name = os.path.join( path, "IMG_%06d.%s" % ( i, ext ) )
+        with open( name, "wb" ) as f:
+            # Unique header so every file has its own md5, then filler
+            header = ( "%s:%d:%d\n" % ( name, seed, i ) )[ :size ]
+            f.write( header )
+            left = size - len( header )
+            while ( left > 0 ):
+                f.write( block[ :left ] )
+                left -= len( block )
+        mtime = time.mktime( ( year, rnd.randint( 1, 12 ), rnd.randint( 1, 28 ), 12, 0, 0, 0, 0, -1 ) )
+        os.utime( name, ( mtime, mtime ) )
+        total += os.path.getsize( name )
+    return files, total
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser( description = 'Generate a synthetic media tree.' )
+    parser.add_argument( 'root', help = 'Directory to create the tree in' )
+    parser.add_argument( '-n', '--files', type = int, default = 1000,
+        help = 'Number of files (default: %(default)s)' )
+    parser.add_argument( '-f', '--folders', type = int, default = 20,
+        help = 'Number of folders (default: %(default)s)' )
+    parser.add_argument( '-s', '--seed', type = int, default = 0,
+        help = 'Random seed (default: %(default)s)' )
+    parser.add_argument( '-x', '--scale', type = float, default = 1.0,
+        help = 'Multiply file sizes by this (default: %(default)s)' )
+    args = parser.parse_args()
+
+    count, total = makeTree( args.root, args.files, args.folders, args.seed, args.scale )
+    print("Created %d files, %.1f MB in %s" % ( count, total / 1e6, args.root ))
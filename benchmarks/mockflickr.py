@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+
+"""
+
+    Local stand-in for the parts of the Flickr API uploadr.py uses, for
+    benchmarks that must not hit the real service.
+
+    Implements the rest/ methods (flickr.auth.*, flickr.photos.delete,
+    flickr.photos.addTags, flickr.photosets.create, flickr.photosets.addPhoto,
+    flickr.photosets.removePhoto, flickr.photosets.getList) and the upload/
+    and replace/ endpoints, keeping photos and sets in memory. Latency, bandwidth and error rate are configurable.
+
+    Usage:
+
+    $ ./mockflickr.py --port 8080 --latency 0.1 --bandwidth 2000000 --error-rate 0.01
+
+    then point api.base in uploadr.py at http://127.0.0.1:8080/services/
+
+"""
+import argparse
+import BaseHTTPServer
+import json
+import random
+import re
+import SocketServer
+import threading
+import time
+import urlparse
+
+class MockFlickr:
+    """ MockFlickr class
+    State of the fake Flickr account and the knobs of the simulation
+    """
+
+    def __init__( self, latency = 0.0, bandwidth = None, errorRate = 0.0, seed = 0 ):
+        """ Constructor
+        latency in seconds per request, bandwidth in bytes per second for
+        upload bodies (None = unlimited), errorRate the share of requests
+        answered with a 500
+        """
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.errorRate = errorRate
+        self.random = random.Random( seed )
+        self.lock = threading.Lock()
+        self.nextId = 1000
+        self.photos = {}
+        self.sets = {}
+        self.calls = {}
+        self.bytes = 0
+
+    def newId( self ):
+        with self.lock:
+            self.nextId += 1
+            return self.nextId
+
+    def count( self, method ):
+        with self.lock:
+            self.calls[ method ] = self.calls.get( method, 0 ) + 1
+
+    def failNow( self ):
+        with self.lock:
+            return self.random.random() < self.errorRate
+
+    def rest( self, q ):
+        """ Answer a rest/ call, returns a dict to send as json
+        """
+        method = q.get( "method" )
+        if ( method in ( "flickr.auth.checkToken", "flickr.auth.getToken" ) ):
+            return { "stat" : "ok", "auth" : { "token" : { "_content" : "mock-token" }, "perms" : { "_content" : "delete" } } }
+        if ( method == "flickr.auth.getFrob" ):
+            return { "stat" : "ok", "frob" : { "_content" : "mock-frob" } }
+        if ( method == "flickr.photos.delete" ):
+            with self.lock:
+                if ( self.photos.pop( q.get( "photo_id" ), None ) is None ):
+                    return { "stat" : "fail", "code" : 1, "message" : "Photo not found" }
+            return { "stat" : "ok" }
+        if ( method == "flickr.photos.addTags" ):
+            with self.lock:
+                if ( q.get( "photo_id" ) not in self.photos ):
+                    return { "stat" : "fail", "code" : 1, "message" : "Photo not found" }
+                self.photos[ q.get( "photo_id" ) ].append( q.get( "tags" ) )
+            return { "stat" : "ok" }
+        if ( method == "flickr.photosets.create" ):
+            setId = str( self.newId() )
+            with self.lock:
+                self.sets[ setId ] = { "title" : q.get( "title" ), "primary" : q.get( "primary_photo_id" ), "photos" : [ q.get( "primary_photo_id" ) ] }
+            return { "stat" : "ok", "photoset" : { "id" : setId } }
+        if ( method == "flickr.photosets.addPhoto" ):
+            with self.lock:
+                if ( q.get( "photoset_id" ) not in self.sets ):
+                    return { "stat" : "fail", "code" : 1, "message" : "Photoset not found" }
+                self.sets[ q.get( "photoset_id" ) ][ "photos" ].append( q.get( "photo_id" ) )
+            return { "stat" : "ok" }
+        if ( method == "flickr.photosets.removePhoto" ):
+            with self.lock:
+                s = self.sets.get( q.get( "photoset_id" ) )
+                if ( s is None ):
+                    return { "stat" : "fail", "code" : 1, "message" : "Photoset not found" }
+                if ( q.get( "photo_id" ) not in s[ "photos" ] ):
+                    return { "stat" : "fail", "code" : 2, "message" : "Photo not in set" }
+                s[ "photos" ].remove( q.get( "photo_id" ) )
+                # Flickr removes a set with its last photo
+                if ( not s[ "photos" ] ):
+                    del self.sets[ q.get( "photoset_id" ) ]
+                elif ( s[ "primary" ] == q.get( "photo_id" ) ):
+                    s[ "primary" ] = s[ "photos" ][ 0 ]
+            return { "stat" : "ok" }
+        if ( method == "flickr.photosets.getList" ):
+            with self.lock:
+                sets = [ { "id" : setId, "title" : { "_content" : s[ "title" ] }, "primary" : s[ "primary" ] } for setId, s in self.sets.items() ]
+            return { "stat" : "ok", "photosets" : { "photoset" : sets } }
+        return { "stat" : "fail", "code" : 112, "message" : "Method \"%s\" not found" % method }
+
+    def upload( self, endpoint, body ):
+        """ Answer an upload/ or replace/ POST, returns the XML answer
+        """
+        if ( endpoint == "replace" ):
+            photoId = re.search( r'name="photo_id"\r\n\r\n(\d+)\r\n', body )
+            if ( photoId is None or photoId.group( 1 ) not in self.photos ):
+                return '<?xml version="1.0" encoding="utf-8" ?>\n<rsp stat="fail"><err code="1" msg="Photo not found" /></rsp>'
+            return '<?xml version="1.0" encoding="utf-8" ?>\n<rsp stat="ok"><photoid>%s</photoid></rsp>' % photoId.group( 1 )
+        photoId = str( self.newId() )
+        with self.lock:
+            self.photos[ photoId ] = []
+        return '<?xml version="1.0" encoding="utf-8" ?>\n<rsp stat="ok"><photoid>%s</photoid></rsp>' % photoId
+
+class Handler( BaseHTTPServer.BaseHTTPRequestHandler ):
+    """ Handler class
+    """
+
+    protocol_version = "HTTP/1.1"
+    # Send each answer in one write, flushed by handle_one_request()
+    wbufsize = -1
+
+    def log_message( self, *args ):
+        pass
+
+    def reply( self, status, body, contentType ):
+        self.send_response( status )
+        self.send_header( "Content-Type", contentType )
+        self.send_header( "Content-Length", str( len( body ) ) )
+        self.end_headers()
+        self.wfile.write( body )
+
+    def readBody( self ):
+        """ Read the request body at the configured bandwidth
+        """
+        mock = self.server.mock
+        remaining = int( self.headers.getheader( "Content-Length", 0 ) )
+        chunks = []
+        start = time.time()
+        received = 0
+        while ( remaining > 0 ):
+            chunk = self.rfile.read( min( remaining, 65536 ) )
+            if ( not chunk ):
+                break
+            chunks.append( chunk )
+            remaining -= len( chunk )
+            received += len( chunk )
+            if ( mock.bandwidth ):
+                wait = start + float( received ) / mock.bandwidth - time.time()
+                if ( wait > 0 ):
+                    time.sleep( wait )
+        with mock.lock:
+            mock.bytes += received
+        return "".join( chunks )
+
+    def do_GET( self ):
+        mock = self.server.mock
+        parts = urlparse.urlsplit( self.path )
+        q = dict( urlparse.parse_qsl( parts.query ) )
+        mock.count( q.get( "method", parts.path ) )
+        time.sleep( mock.latency )
+        if ( mock.failNow() ):
+            self.reply( 500, "Internal Server Error", "text/plain" )
+        else:
+            self.reply( 200, json.dumps( mock.rest( q ) ), "application/json" )
+
+    def do_POST( self ):
+        mock = self.server.mock
+        endpoint = self.path.strip( "/" ).split( "/" )[ -1 ]
+        mock.count( endpoint )
+        body = self.readBody()
+        time.sleep( mock.latency )
+        if ( mock.failNow() ):
+            self.reply( 500, "Internal Server Error", "text/plain" )
+        else:
+            self.reply( 200, mock.upload( endpoint, body ), "text/xml" )
+
+class Server( SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer ):
+    """ Server class
+    """
+
+    daemon_threads = True
+    request_queue_size = 128
+
+def start( mock, port = 0 ):
+    """ Serve mock in a background thread, returns (server, base url to use as api.base)
+    """
+    server = Server( ( "127.0.0.1", port ), Handler )
+    server.mock = mock
+    thread = threading.Thread( target = server.serve_forever )
+    thread.daemon = True
+    thread.start()
+    return server, "http://127.0.0.1:%d/services/" % server.server_address[ 1 ]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser( description = 'Local stand-in for the Flickr API.' )
+    parser.add_argument( '-p', '--port', type = int, default = 8080,
+        help = 'Port to listen on (default: %(default)s)' )
+    parser.add_argument( '-l', '--latency', type = float, default = 0.0,
+        help = 'Seconds added to every request' )
+    parser.add_argument( '-b', '--bandwidth', type = int, default = None,
+        help = 'Bytes per second accepted for uploads (default: unlimited)' )
+    parser.add_argument( '-e', '--error-rate', type = float, default = 0.0,
+        help = 'Share of requests answered with a 500' )
+    args = parser.parse_args()
+
+    server, base = start( MockFlickr( args.latency, args.bandwidth, args.error_rate ), args.port )
+    print("Mock Flickr API listening on " + base)
+    try:
+        while True:
+            time.sleep( 60 )
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -30,6 +30,7 @@
     DB_PATH = os.path.join(FILES_DIR, "fickerdb")
     FLICKR["api_key"] = ""
     FLICKR["secret"] = ""
+    or put them in uploadr.ini, see uploadr.ini.sample (several media trees can be set up there).
     Place the file uploadr.py in any directory and run:
 
     $ ./uploadr.py
@@ -61,31 +62,40 @@ if sys.version_info < (2,7):
   sys.exit(1)
 
 import argparse
+import array
+import binascii
+import collections
+import ConfigParser
+import contextlib
+import copy
 import hashlib
-import mimetools
-import mimetypes
 import os
 import shelve
+import signal
 import string
+import threading
 import time
-import urllib
-import urllib2
-import webbrowser
 import sqlite3 as lite
 import pprint
-import json
-from xml.dom.minidom import parse
 import hashlib
-import fcntl
-import errno
 from sys import stdout
 import itertools
+import marshal
+from cStringIO import StringIO
+# The network stack, json, the XML parser and the profiler are imported where
+# they are used: a cron run with nothing to do never needs them
 
 #
 ##
 ##  Items you will want to change
 ##
 
+#
+#   Config file overriding the settings below, also the place to set up
+#   several media trees (see uploadr.ini.sample). Used when it exists,
+#   -c/--config picks another one.
+#
+CONFIG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "uploadr.ini")
 #
 # Location to scan for new files
 #
@@ -106,15 +116,52 @@ FLICKR = {
 #
 SLEEP_TIME = 1 * 60
 #
+#   Only with --daemon option:
+#     How often each phase runs (in seconds). The tree is rescanned every
+#     SLEEP_TIME, but folders that haven't changed are not listed again: files
+#     modified in place are only noticed by the full rescan every DAEMON_FULL_SCAN
+#
+DAEMON_INTERVALS = {
+        "removeUselessSetsTable"    : 24 * 60 * 60,
+        "getFlickrSets"             : 24 * 60 * 60,
+        "upload"                    : SLEEP_TIME,
+        "removeDeletedMedia"        : 60 * 60,
+        "createSets"                : 10 * 60,
+        "addTagsToUploadedPhotos"   : 10 * 60
+        }
+DAEMON_FULL_SCAN = 6 * 60 * 60
+#
 #   Only with --drip-feed option:
 #     How often to wait between uploading individual files (in seconds)
 #
 DRIP_TIME = 1 * 60
 #
-#   File we keep the history of uploaded files in.
+#   File we keep the history of uploaded files in. A snapshot of it for quick
+#   starts is kept next to it, in the same name with ".index" appended.
 #
 DB_PATH = os.path.join(FILES_DIR, "fickerdb")
 #
+#   Several uploader processes may work on the same library at once, they
+#   claim work through leases in the database. A lease that isn't renewed for
+#   LEASE_TIME seconds (crashed process) is taken over by the others.
+#   WAL lets the processes read while one of them writes, but only works when
+#   they all run on the same host: set DB_WAL = False if processes on several
+#   hosts open the database over a network share.
+#
+LEASE_TIME = 5 * 60
+DB_WAL = True
+#
+#   Only with --plan: upload bandwidth in bytes per second assumed for the time
+#   estimate when neither the last run (RUN_SUMMARY_FILE) nor BANDWIDTH_LIMIT tell
+#
+PLAN_BANDWIDTH = 1000000
+#
+#   Run metrics: a Prometheus textfile (for node_exporter's textfile collector)
+#   and a JSON summary of the run. Set to "" to not write them.
+#
+METRICS_FILE = os.path.join(FILES_DIR, "uploadr.prom")
+RUN_SUMMARY_FILE = os.path.join(FILES_DIR, "uploadr-summary.json")
+#
 #   List of folder names you don't want to parse
 #
 EXCLUDED_FOLDERS = ["@eaDir","#recycle",".picasaoriginals","_ExcludeSync","Corel Auto-Preserve","Originals","Automatisch beibehalten von Corel"]
@@ -127,10 +174,61 @@ ALLOWED_EXT = ["jpg","png","avi","mov","mpg","mp4"]
 #
 FILE_MAX_SIZE = 50000000
 #
+#   Name of the set a file goes to: {folder} is the name of its folder,
+#   {parent} the name of the folder above that, {path} its folder relative to
+#   FILES_DIR and {root} the name of its media tree (see the config file)
+#
+SET_NAME = "{folder}"
+#
+#   Number of files uploaded at the same time from each media tree
+#
+UPLOAD_WORKERS = 1
+#
 #   Do you want to verify each time if already uploaded files have been changed?
 #
 MANAGE_CHANGES = True
 #
+#   Safety net for deletions: abort when more than this share of the library
+#   (0.1 = 10%) would be removed from Flickr in one run, e.g. when the disk
+#   isn't mounted. Use --force-delete to go ahead anyway, 0 disables the check.
+#
+MAX_DELETE_RATIO = 0.1
+#
+#   Flickr API client: number of calls in flight at the same time, API calls
+#   allowed per hour (Flickr's limit is 3600) and how often a failed call is retried
+#
+API_WORKERS = 8
+API_CALLS_PER_HOUR = 3600
+API_RETRIES = 3
+#
+#   Order in which new files are uploaded: "newest" (latest modified first),
+#   "smallest", "folders" (round-robin across folders) or "path" (alphabetical)
+#
+UPLOAD_ORDER = "newest"
+#
+#   Folders (relative to FILES_DIR) that are always uploaded first, e.g. ["Phone"]
+#
+PRIORITY_FOLDERS = []
+#
+#   Files bigger than LARGE_FILE_SIZE still get this share of the uploads
+#   (0.2 = every 5th upload) so they are not starved by a flow of small files
+#
+LARGE_FILE_SIZE = 10000000
+LARGE_FILE_SHARE = 0.2
+#
+#   Upload bandwidth in bytes per second (None = unlimited, 0 = don't upload).
+#   BANDWIDTH_SCHEDULE overrides it during the given hours, e.g.
+#   [ ("08:00", "18:00", 2000000) ] caps uploads at 2 MB/s during office hours.
+#   Only photo uploads are throttled, tags, sets and deletions are not.
+#
+BANDWIDTH_LIMIT = None
+BANDWIDTH_SCHEDULE = []
+#
+#   While uploads run, the sets and tags of the files already uploaded are done
+#   every METADATA_INTERVAL seconds, they don't wait for the uploads to finish
+#
+METADATA_INTERVAL = 60
+#
 #   Your own API key and secret message
 #
 FLICKR["api_key"] = ""
@@ -157,22 +255,314 @@ class APIConstants:
 
 api = APIConstants()
 
-class Uploadr:
-    """ Uploadr class
+class Metrics:
+    """ Metrics class
+    Counters, gauges, phase timers and API latency histograms of a run,
+    written as a Prometheus textfile and a JSON summary
     """
 
-    token = None
-    perms = ""
-    TOKEN_FILE = os.path.join(FILES_DIR, "flickrToken")
+    LATENCY_BUCKETS = ( 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300 )
+
+    HELP = {
+        "uploadr_phase_seconds"                : ( "gauge", "Time spent in each phase of the run" ),
+        "uploadr_phase_runs"                   : ( "gauge", "Number of times each phase ran" ),
+        "uploadr_files_total"                  : ( "counter", "Files handled, by action" ),
+        "uploadr_upload_bytes_total"           : ( "counter", "Bytes uploaded or replaced" ),
+        "uploadr_upload_files_per_second"      : ( "gauge", "Files uploaded or replaced per second of the upload phase" ),
+        "uploadr_upload_bytes_per_second"      : ( "gauge", "Bytes uploaded or replaced per second of the upload phase" ),
+        "uploadr_api_errors_total"             : ( "counter", "Failed Flickr API calls, by method" ),
+        "uploadr_api_retries_total"            : ( "counter", "Retried Flickr API calls, by method" ),
+        "uploadr_queue_depth"                  : ( "gauge", "Work items waiting, by queue" ),
+        "uploadr_api_request_duration_seconds" : ( "histogram", "Flickr API latency, by method" ),
+        "uploadr_last_run_timestamp_seconds"   : ( "gauge", "When the metrics were written" )
+    }
 
     def __init__( self ):
         """ Constructor
         """
-        self.token = self.getCachedToken()
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.values = {}
+        self.phases = {}
+        self.latencies = {}
+
+    def key( self, name, labels ):
+        return ( name, tuple( sorted( labels.items() ) ) )
 
+    def inc( self, name, value = 1, **labels ):
+        """ Add value to a counter
+        """
+        key = self.key( name, labels )
+        with self.lock:
+            self.values[ key ] = self.values.get( key, 0 ) + value
 
+    def gauge( self, name, value, **labels ):
+        """ Set a gauge
+        """
+        with self.lock:
+            self.values[ self.key( name, labels ) ] = value
 
-    def signCall( self, data):
+    def observe( self, method, seconds ):
+        """ Record the latency of one API call
+        """
+        with self.lock:
+            buckets = self.latencies.setdefault( method, [ 0 ] * ( len( self.LATENCY_BUCKETS ) + 2 ) )
+            for i, bound in enumerate( self.LATENCY_BUCKETS ):
+                if ( seconds <= bound ):
+                    buckets[ i ] += 1
+            buckets[ -2 ] += seconds
+            buckets[ -1 ] += 1
+
+    @contextlib.contextmanager
+    def phase( self, name ):
+        """ with metrics.phase("upload"): ... adds the time spent to the phase
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            with self.lock:
+                seconds, runs = self.phases.get( name, ( 0.0, 0 ) )
+                self.phases[ name ] = ( seconds + time.time() - start, runs + 1 )
+
+    def rates( self ):
+        """ Files and bytes per second of upload time
+        """
+        seconds = self.phases.get( "upload", ( 0.0, 0 ) )[ 0 ]
+        files = sum( value for ( name, labels ), value in self.values.items() if name == "uploadr_files_total" and dict( labels ).get( "action" ) in ( "uploaded", "replaced" ) )
+        bytes = self.values.get( self.key( "uploadr_upload_bytes_total", {} ), 0 )
+        if ( seconds <= 0 ):
+            return 0.0, 0.0
+        return files / seconds, bytes / seconds
+
+    def prometheus( self ):
+        """ Metrics in the Prometheus text format
+        """
+        values = dict( self.values )
+        for name, ( seconds, runs ) in self.phases.items():
+            values[ self.key( "uploadr_phase_seconds", { "phase" : name } ) ] = seconds
+            values[ self.key( "uploadr_phase_runs", { "phase" : name } ) ] = runs
+        filesRate, bytesRate = self.rates()
+        values[ self.key( "uploadr_upload_files_per_second", {} ) ] = filesRate
+        values[ self.key( "uploadr_upload_bytes_per_second", {} ) ] = bytesRate
+        values[ self.key( "uploadr_last_run_timestamp_seconds", {} ) ] = time.time()
+
+        def line( name, labels, value ):
+            if ( labels ):
+                name += "{" + ",".join( '%s="%s"' % ( k, str( v ).replace( "\\", "\\\\" ).replace( '"', '\\"' ) ) for k, v in labels ) + "}"
+            return "%s %r" % ( name, float( value ) )
+
+        L = []
+        for metric in sorted( set( name for name, labels in values ) ):
+            kind, text = self.HELP.get( metric, ( "untyped", metric ) )
+            L.append( "# HELP %s %s" % ( metric, text ) )
+            L.append( "# TYPE %s %s" % ( metric, kind ) )
+            for ( name, labels ), value in sorted( values.items() ):
+                if ( name == metric ):
+                    L.append( line( name, labels, value ) )
+        metric = "uploadr_api_request_duration_seconds"
+        kind, text = self.HELP[ metric ]
+        L.append( "# HELP %s %s" % ( metric, text ) )
+        L.append( "# TYPE %s %s" % ( metric, kind ) )
+        for method, buckets in sorted( self.latencies.items() ):
+            for bound, count in zip( self.LATENCY_BUCKETS, buckets ):
+                L.append( line( metric + "_bucket", ( ( "le", repr( float( bound ) ) ), ( "method", method ) ), count ) )
+            L.append( line( metric + "_bucket", ( ( "le", "+Inf" ), ( "method", method ) ), buckets[ -1 ] ) )
+            L.append( line( metric + "_sum", ( ( "method", method ), ), buckets[ -2 ] ) )
+            L.append( line( metric + "_count", ( ( "method", method ), ), buckets[ -1 ] ) )
+        return "\n".join( L ) + "\n"
+
+    def summary( self ):
+        """ Metrics of the run as a dict for the JSON summary
+        """
+        filesRate, bytesRate = self.rates()
+        counters = {}
+        for ( name, labels ), value in sorted( self.values.items() ):
+            counters[ name + "".join( "." + str( v ) for k, v in labels ) ] = value
+        return {
+            "start"            : self.start,
+            "end"              : time.time(),
+            "duration"         : time.time() - self.start,
+            "phases"           : dict( ( name, { "seconds" : seconds, "runs" : runs } ) for name, ( seconds, runs ) in self.phases.items() ),
+            "files_per_second" : filesRate,
+            "bytes_per_second" : bytesRate,
+            "counters"         : counters,
+            "api"              : dict( ( method, { "calls" : b[ -1 ], "seconds" : b[ -2 ], "average" : b[ -2 ] / b[ -1 ] } ) for method, b in self.latencies.items() if b[ -1 ] )
+        }
+
+    def write( self ):
+        """ Write METRICS_FILE and RUN_SUMMARY_FILE, replacing the old ones in one go
+        so node_exporter never sees a half written file
+        """
+        import json
+        with self.lock:
+            for path, content in ( ( METRICS_FILE, self.prometheus ), ( RUN_SUMMARY_FILE, lambda: json.dumps( self.summary(), indent = 2, sort_keys = True ) ) ):
+                if ( not path ):
+                    continue
+                try:
+                    with open( path + ".tmp", "w" ) as f:
+                        f.write( content() )
+                    os.rename( path + ".tmp", path )
+                except ( IOError, OSError ), e:
+                    print("Error writing " + path + ": " + str(e))
+
+metrics = Metrics()
+
+class PhaseProfiler:
+    """ PhaseProfiler class
+    cProfile for each phase of a run (--profile DIR). Writes DIR/<phase>.prof
+    for pstats or snakeviz and the top hot spots of every phase to
+    DIR/hotspots.txt. Only the main thread is profiled: work done on the
+    FlickrClient worker threads shows up as time spent waiting in map().
+    """
+
+    TOP = 25
+
+    def __init__( self, directory ):
+        """ Constructor
+        """
+        self.directory = directory
+        self.names = []
+        self.profiles = {}
+
+    @contextlib.contextmanager
+    def phase( self, name ):
+        """ with profiler.phase("upload"): ... profiles the block, adding up repeated runs
+        """
+        import cProfile
+        if ( name not in self.profiles ):
+            self.names.append( name )
+            self.profiles[ name ] = cProfile.Profile()
+        profile = self.profiles[ name ]
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+
+    def write( self ):
+        """ Dump the profiles and the hot spots report
+        """
+        import pstats
+        if ( not os.path.isdir( self.directory ) ):
+            os.makedirs( self.directory )
+        report = StringIO()
+        for name in self.names:
+            profile = self.profiles[ name ]
+            profile.dump_stats( os.path.join( self.directory, name + ".prof" ) )
+            stats = pstats.Stats( profile, stream = report )
+            report.write( "=" * 30 + " " + name + " " + "=" * 30 + "\n" )
+            stats.sort_stats( "cumulative" ).print_stats( self.TOP )
+            stats.sort_stats( "tottime" ).print_stats( self.TOP )
+        with open( os.path.join( self.directory, "hotspots.txt" ), "w" ) as f:
+            f.write( report.getvalue() )
+        print("Profiles written to " + self.directory)
+
+class RateLimiter:
+    """ RateLimiter class
+    Token bucket shared by all threads talking to Flickr
+    """
+
+    def __init__( self, rate, burst ):
+        """ Constructor, rate in calls per second (0 = unlimited)
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def acquire( self ):
+        """ Block until a call may be made
+        """
+        if ( self.rate <= 0 ):
+            return
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min( self.burst, self.tokens + ( now - self.last ) * self.rate )
+                self.last = now
+                if ( self.tokens >= 1 ):
+                    self.tokens -= 1
+                    return
+                wait = ( 1 - self.tokens ) / self.rate
+            time.sleep( wait )
+
+class ConnectionPool:
+    """ ConnectionPool class
+    Keeps HTTP connections to Flickr open between calls. Connections idle for
+    more than maxIdle seconds are dropped, servers close them sooner or later
+    """
+
+    def __init__( self, size, timeout = 60, maxIdle = 5 ):
+        """ Constructor
+        """
+        self.size = size
+        self.timeout = timeout
+        self.maxIdle = maxIdle
+        self.idle = {}                       # (scheme, host) -> [(connection, last used)]
+        self.lock = threading.Lock()
+
+    def get( self, scheme, host, reuse = True ):
+        """ Take an idle connection to host (unless reuse is False) or open a new one
+        Returns (connection, True if it was used before)
+        """
+        import httplib
+        import socket
+        with self.lock:
+            conns = self.idle.get( ( scheme, host ) ) if reuse else None
+            while ( conns ):
+                conn, used = conns.pop()
+                if ( time.time() - used <= self.maxIdle ):
+                    return conn, True
+                conn.close()
+        if ( scheme == "https" ):
+            conn = httplib.HTTPSConnection( host, timeout = self.timeout )
+        else:
+            conn = httplib.HTTPConnection( host, timeout = self.timeout )
+        # Headers and streamed bodies go out in separate writes, don't let Nagle hold them back
+        conn.connect()
+        conn.sock.setsockopt( socket.IPPROTO_TCP, socket.TCP_NODELAY, 1 )
+        return conn, False
+
+    def put( self, scheme, host, conn ):
+        """ Give a connection back for reuse
+        """
+        with self.lock:
+            conns = self.idle.setdefault( ( scheme, host ), [] )
+            if ( len( conns ) < self.size ):
+                conns.append( ( conn, time.time() ) )
+                return
+        conn.close()
+
+    def close( self ):
+        """ Close all the idle connections
+        """
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for conns in idle.values():
+            for conn, used in conns:
+                conn.close()
+
+class FlickrClient:
+    """ FlickrClient class
+    Concurrent Flickr API client. All calls share a connection pool, a rate
+    limiter and retry handling. callAsync() and map() run calls on a pool of
+    API_WORKERS threads, call() is the blocking version used by Uploadr.
+    """
+
+    # Flickr error codes worth trying again: "Service currently unavailable"
+    RETRY_CODES = ( 105, )
+
+    def __init__( self ):
+        """ Constructor
+        """
+        self.pool = ConnectionPool( API_WORKERS )
+        self.limiter = RateLimiter( API_CALLS_PER_HOUR / 3600.0, max( 1, API_WORKERS ) )
+        self.workers = None
+        self.lock = threading.Lock()
+
+    def signature( self, data ):
         """
         Signs args via md5 per http://www.flickr.com/services/api/auth.spec.html (Section 8)
         """
@@ -183,13 +573,1193 @@ class Uploadr:
             foo += (a + data[a])
 
         f = FLICKR[ "secret" ] + "api_key" + FLICKR[ "api_key" ] + foo
-        #f = "api_key" + FLICKR[ "api_key" ] + foo
 
         return hashlib.md5( f ).hexdigest()
 
+    def send( self, method, url, body = None, headers = None, retries = API_RETRIES, name = None ):
+        """ Send a request through the connection pool and return the response body
+        Connection errors and 5xx answers are retried with a growing delay. A
+        pooled connection that turns out to be closed by the server (writing the
+        request fails, or it hangs up without a byte of answer) is not an attempt,
+        a GET goes again at once on a fresh connection. Other methods (uploads)
+        always get a fresh connection, they are never sent twice that way.
+        name labels the call in the metrics, default is the last part of the url path
+        """
+        import httplib
+        import socket
+        import urllib2
+        import urlparse
+        parts = urlparse.urlsplit( url )
+        path = parts.path
+        if ( parts.query ):
+            path += "?" + parts.query
+        name = name or parts.path.strip( "/" ).split( "/" )[ -1 ]
+        idempotent = ( method == "GET" )
+        attempt = 0
+        stale = False
+        while True:
+            if ( not stale ):
+                self.limiter.acquire()
+            conn = None
+            reused = False
+            sent = False
+            start = time.time()
+            try:
+                conn, reused = self.pool.get( parts.scheme, parts.netloc, reuse = idempotent )
+                conn.request( method, path, body, headers or {} )
+                sent = True
+                response = conn.getresponse()
+                data = response.read()
+            except ( socket.error, httplib.HTTPException ), e:
+                if ( conn is not None ):
+                    conn.close()
+                closed = isinstance( e, httplib.BadStatusLine ) and e.line.startswith( "No status line received" )
+                stale = reused and not isinstance( e, socket.timeout ) and ( not sent or closed )
+                if ( stale ):
+                    continue
+                error = e
+            else:
+                if ( response.will_close ):
+                    conn.close()
+                else:
+                    self.pool.put( parts.scheme, parts.netloc, conn )
+                if ( response.status == 200 ):
+                    metrics.observe( name, time.time() - start )
+                    return data
+                error = urllib2.HTTPError( url, response.status, response.reason, response.msg, None )
+            metrics.observe( name, time.time() - start )
+            if ( attempt >= retries or ( isinstance( error, urllib2.HTTPError ) and error.code < 500 ) ):
+                metrics.inc( "uploadr_api_errors_total", method = name )
+                raise error
+            attempt += 1
+            metrics.inc( "uploadr_api_retries_total", method = name )
+            print("Retrying (" + str(attempt) + "/" + str(retries) + ") after error: " + str(error))
+            time.sleep( 2 ** attempt )
+
+    def get( self, url, name = None ):
+        """ GET url and decode the json answer
+        """
+        import json
+        return json.loads( self.send( "GET", url, name = name ) )
+
+    def call( self, data ):
+        """ Sign data, call the REST endpoint and return the decoded json answer
+        """
+        import urllib
+        data = dict( data )
+        data[ "api_sig" ] = self.signature( data )
+        data[ "api_key" ] = FLICKR[ "api_key" ]
+        url = api.rest + "?" + urllib.urlencode( data )
+        attempt = 0
+        while True:
+            res = self.get( url, data.get( "method" ) )
+            if ( res.get( "stat" ) != "fail" ):
+                return res
+            if ( res.get( "code" ) not in self.RETRY_CODES or attempt >= API_RETRIES ):
+                metrics.inc( "uploadr_api_errors_total", method = data.get( "method" ) )
+                return res
+            attempt += 1
+            metrics.inc( "uploadr_api_retries_total", method = data.get( "method" ) )
+            print("Retrying (" + str(attempt) + "/" + str(API_RETRIES) + ") " + str(data.get("method")) + ": " + str(res.get("message")))
+            time.sleep( 2 ** attempt )
+
+    def getWorkers( self ):
+        """ Thread pool for concurrent calls, started on first use
+        """
+        from multiprocessing.pool import ThreadPool
+        with self.lock:
+            if ( self.workers is None ):
+                self.workers = ThreadPool( API_WORKERS )
+            return self.workers
+
+    def callAsync( self, data ):
+        """ Start a call in the background, returns a result with a get() method
+        """
+        return self.getWorkers().apply_async( self.call, ( data, ) )
+
+    def map( self, func, items ):
+        """ Run func (which may use call()) on all items concurrently, results in order
+        Don't use callAsync() or map() from within func, the workers would wait on themselves
+        """
+        return self.getWorkers().map( func, items )
+
+    def close( self ):
+        """ Stop the worker threads and close the pooled connections
+        """
+        with self.lock:
+            workers, self.workers = self.workers, None
+        if ( workers is not None ):
+            workers.close()
+            workers.join()
+        self.pool.close()
+
+class BandwidthLimiter:
+    """ BandwidthLimiter class
+    Caps the bytes per second sent in upload bodies, following BANDWIDTH_LIMIT
+    and the time-of-day windows of BANDWIDTH_SCHEDULE. Shared by all uploads.
+    """
+
+    def __init__( self ):
+        """ Constructor
+        """
+        self.lock = threading.Lock()
+        self.rate = None
+        self.start = time.time()
+        self.sent = 0
+
+    def minutes( self, value ):
+        """ "HH:MM" to minutes since midnight
+        """
+        hours, minutes = value.split( ":" )
+        return int( hours ) * 60 + int( minutes )
+
+    def currentLimit( self, now = None ):
+        """ Bytes per second allowed at time now (default: right now)
+        """
+        local = time.localtime( now )
+        minutes = local.tm_hour * 60 + local.tm_min
+        for start, end, limit in BANDWIDTH_SCHEDULE:
+            start, end = self.minutes( start ), self.minutes( end )
+            if ( start <= minutes < end or ( end < start and ( minutes >= start or minutes < end ) ) ):
+                return limit
+        return BANDWIDTH_LIMIT
+
+    def paused( self ):
+        """ True while the schedule doesn't allow any uploads
+        """
+        return self.currentLimit() == 0
+
+    def throttle( self, nbytes ):
+        """ Called before sending nbytes, sleeps as long as needed to stay under the limit
+        Pauses are up to the callers, between files: an upload already on its way
+        when a pause starts goes on at the rate it had
+        """
+        limit = self.currentLimit()
+        with self.lock:
+            if ( limit == 0 ):
+                limit = self.rate
+            now = time.time()
+            # Start over when the limit changes, and regularly so idle time isn't saved up for a burst
+            if ( limit != self.rate or now - self.start > 10 ):
+                self.rate = limit
+                self.start = now
+                self.sent = 0
+            self.sent += nbytes
+            if ( limit is None ):
+                return
+            wait = self.start + float( self.sent ) / limit - now
+        if ( wait > 0 ):
+            time.sleep( wait )
+
+class MultipartBody:
+    """ MultipartBody class
+    File-like multipart/form-data body that reads the photo from disk while it
+    is sent, so uploads don't hold the whole file in memory and go through
+    the BandwidthLimiter
+    """
+
+    def __init__( self, head, path, tail, limiter ):
+        """ Constructor
+        """
+        self.parts = [ StringIO( head ), open( path, 'rb' ), StringIO( tail ) ]
+        self.length = len( head ) + os.path.getsize( path ) + len( tail )
+        self.limiter = limiter
+
+    def __len__( self ):
+        return self.length
+
+    def read( self, size = 8192 ):
+        """ Next chunk of the body, "" at the end
+        """
+        while ( self.parts ):
+            data = self.parts[ 0 ].read( size )
+            if ( data ):
+                self.limiter.throttle( len( data ) )
+                return data
+            self.parts.pop( 0 ).close()
+        return ""
+
+    def close( self ):
+        for part in self.parts:
+            part.close()
+        self.parts = []
+
+class Leases:
+    """ Leases class
+    Work claims stored in the leases table of the database, so that several
+    uploader processes can share one library. Claims held by this process are
+    renewed in the background until released, claims of a crashed process
+    expire after LEASE_TIME seconds and can be taken over.
+    """
+
+    def __init__( self ):
+        """ Constructor
+        """
+        # os.uname() is gethostname() without loading the network stack
+        self.owner = "%s:%d:%s" % ( os.uname()[ 1 ], os.getpid(), os.urandom( 4 ).encode( "hex" ) )
+        self.con = None
+        self.heartbeat = None
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+
+    def execute( self, statements ):
+        """ Run (sql, parameters) statements in one immediate transaction, returns the rowcount of the last one
+        """
+        with self.lock:
+            if ( self.con is None ):
+                self.con = lite.connect( DB_PATH, timeout = LEASE_TIME, isolation_level = None, check_same_thread = False )
+            cur = self.con.cursor()
+            cur.execute( "BEGIN IMMEDIATE" )
+            try:
+                for sql, parameters in statements:
+                    cur.execute( sql, parameters )
+                rowcount = cur.rowcount
+                cur.execute( "COMMIT" )
+            except:
+                cur.execute( "ROLLBACK" )
+                raise
+            return rowcount
+
+    def claim( self, item ):
+        """ Try to claim item, True if this process holds it now
+        """
+        now = time.time()
+        claimed = self.execute( [
+            ( "INSERT OR IGNORE INTO leases (item, owner, expires) VALUES (?, ?, ?)", ( item, self.owner, now + LEASE_TIME ) ),
+            ( "UPDATE leases SET owner = ?, expires = ? WHERE item = ? AND (owner = ? OR expires < ?)", ( self.owner, now + LEASE_TIME, item, self.owner, now ) )
+        ] ) == 1
+        if ( claimed and self.heartbeat is None ):
+            self.heartbeat = threading.Thread( target = self.renew )
+            self.heartbeat.daemon = True
+            self.heartbeat.start()
+        return claimed
+
+    def release( self, item ):
+        """ Give item back
+        """
+        self.execute( [ ( "DELETE FROM leases WHERE item = ? AND owner = ?", ( item, self.owner ) ) ] )
+
+    def releaseAll( self ):
+        """ Give back everything this process holds and clean up expired claims
+        """
+        self.execute( [ ( "DELETE FROM leases WHERE owner = ? OR expires < ?", ( self.owner, time.time() ) ) ] )
+
+    def renew( self ):
+        """ Heartbeat thread: keep the claims of this process alive
+        """
+        while ( not self.stopped.wait( LEASE_TIME / 3.0 ) ):
+            try:
+                self.execute( [ ( "UPDATE leases SET expires = ? WHERE owner = ?", ( time.time() + LEASE_TIME, self.owner ) ) ] )
+            except lite.Error, e:
+                print("Error renewing leases: %s" % e.args[0])
+
+    def close( self ):
+        """ Give back all the claims, stop the heartbeat and close the connection
+        """
+        self.stopped.set()
+        with self.lock:
+            con, self.con = self.con, None
+        if ( con is not None ):
+            con.execute( "DELETE FROM leases WHERE owner = ?", ( self.owner, ) )
+            con.close()
+
+class Root:
+    """ Root class
+    One media tree to upload. Its filters, set naming, Flickr settings and
+    number of uploads at a time default to the global settings.
+    """
+
+    FLICKR_KEYS = ( "title", "description", "tags", "is_public", "is_friend", "is_family" )
+
+    def __init__( self, name, path, options = None ):
+        """ Constructor, options are the settings of its [root NAME] section
+        """
+        options = options or {}
+        self.name = name
+        self.path = os.path.normpath( path )
+        # Scanned paths are normalized, "./" is dropped
+        self.prefix = "" if self.path == os.curdir else os.path.join( self.path, "" )
+        self.allowedExt = options.get( "allowed_ext", ALLOWED_EXT )
+        self.excludedFolders = options.get( "excluded_folders", EXCLUDED_FOLDERS )
+        self.fileMaxSize = options.get( "file_max_size", FILE_MAX_SIZE )
+        self.priorityFolders = options.get( "priority_folders", PRIORITY_FOLDERS )
+        self.setNameFormat = options.get( "set_name", SET_NAME )
+        self.workers = options.get( "upload_workers", UPLOAD_WORKERS )
+        self.flickr = dict( ( key, options.get( key, FLICKR[ key ] ) ) for key in self.FLICKR_KEYS )
+
+    def contains( self, path ):
+        """ True if path is below this root
+        """
+        return path.startswith( self.prefix )
+
+    def setName( self, path ):
+        """ Name of the set of a file below this root, following its set_name
+        """
+        folder = os.path.dirname( path )
+        return self.setNameFormat.format( folder = os.path.basename( folder ),
+            parent = os.path.basename( os.path.dirname( folder ) ),
+            path = os.path.relpath( folder, self.path ), root = self.name )
+
+ROOTS = []
+
+class Config:
+    """ Config class
+    The config file, in INI format (see uploadr.ini.sample). The [uploadr]
+    section overrides the settings at the top of this file, each [root NAME]
+    section adds a media tree. The whole file is checked before anything is
+    applied, all the problems found are raised together as one ValueError.
+    """
+
+    # [uploadr] section: key -> (global it sets, type). None sets FLICKR[key]
+    SETTINGS = {
+        "files_dir"          : ( "FILES_DIR", "str" ),
+        "db_path"            : ( "DB_PATH", "str" ),
+        "token_file"         : ( "TOKEN_FILE", "str" ),
+        "metrics_file"       : ( "METRICS_FILE", "str" ),
+        "run_summary_file"   : ( "RUN_SUMMARY_FILE", "str" ),
+        "api_key"            : ( None, "str" ),
+        "secret"             : ( None, "str" ),
+        "sleep_time"         : ( "SLEEP_TIME", "int" ),
+        "daemon_intervals"   : ( "DAEMON_INTERVALS", "intervals" ),
+        "daemon_full_scan"   : ( "DAEMON_FULL_SCAN", "int" ),
+        "drip_time"          : ( "DRIP_TIME", "int" ),
+        "lease_time"         : ( "LEASE_TIME", "int" ),
+        "db_wal"             : ( "DB_WAL", "bool" ),
+        "plan_bandwidth"     : ( "PLAN_BANDWIDTH", "int" ),
+        "manage_changes"     : ( "MANAGE_CHANGES", "bool" ),
+        "max_delete_ratio"   : ( "MAX_DELETE_RATIO", "float" ),
+        "api_workers"        : ( "API_WORKERS", "int" ),
+        "api_calls_per_hour" : ( "API_CALLS_PER_HOUR", "int" ),
+        "api_retries"        : ( "API_RETRIES", "int" ),
+        "upload_order"       : ( "UPLOAD_ORDER", "str" ),
+        "large_file_size"    : ( "LARGE_FILE_SIZE", "int" ),
+        "large_file_share"   : ( "LARGE_FILE_SHARE", "float" ),
+        "bandwidth_limit"    : ( "BANDWIDTH_LIMIT", "limit" ),
+        "bandwidth_schedule" : ( "BANDWIDTH_SCHEDULE", "schedule" ),
+        "metadata_interval"  : ( "METADATA_INTERVAL", "int" )
+    }
+
+    # [root NAME] sections, their defaults can be set in [uploadr]
+    ROOT_SETTINGS = {
+        "allowed_ext"        : ( "ALLOWED_EXT", "list" ),
+        "excluded_folders"   : ( "EXCLUDED_FOLDERS", "list" ),
+        "file_max_size"      : ( "FILE_MAX_SIZE", "int" ),
+        "priority_folders"   : ( "PRIORITY_FOLDERS", "list" ),
+        "set_name"           : ( "SET_NAME", "str" ),
+        "upload_workers"     : ( "UPLOAD_WORKERS", "int" ),
+        "title"              : ( None, "str" ),
+        "description"        : ( None, "str" ),
+        "tags"               : ( None, "str" ),
+        "is_public"          : ( None, "str" ),
+        "is_friend"          : ( None, "str" ),
+        "is_family"          : ( None, "str" )
+    }
+
+    BOOLEANS = { "1" : True, "yes" : True, "true" : True, "on" : True, "0" : False, "no" : False, "false" : False, "off" : False }
+
+    # Files kept next to the media by default, they follow the first root
+    DEFAULT_FILES = ( ( "DB_PATH", "fickerdb" ), ( "TOKEN_FILE", "flickrToken" ), ( "METRICS_FILE", "uploadr.prom" ), ( "RUN_SUMMARY_FILE", "uploadr-summary.json" ) )
+
+    # The settings as written in this file, restored before a config file is applied again
+    defaults = None
+
+    def __init__( self, path ):
+        """ Read and check the config file at path
+        """
+        self.path = path
+        self.settings = {}
+        self.roots = []
+        self.warnings = []
+        parser = ConfigParser.RawConfigParser()
+        try:
+            if ( not parser.read( path ) ):
+                raise ValueError( "Cannot read the config file " + path )
+        except ConfigParser.Error, e:
+            raise ValueError( "Error in the config file " + str( e ) )
+        errors = []
+        for section in parser.sections():
+            if ( section == "uploadr" ):
+                kinds = dict( self.SETTINGS, **self.ROOT_SETTINGS )
+                target = self.settings
+            elif ( section.startswith( "root " ) and section[ 5: ].strip() ):
+                kinds = dict( self.ROOT_SETTINGS, path = ( None, "str" ) )
+                target = {}
+                self.roots.append( ( section[ 5: ].strip(), target ) )
+            else:
+                errors.append( "[%s]: unknown section" % section )
+                continue
+            for key, value in parser.items( section ):
+                if ( key not in kinds ):
+                    errors.append( "[%s] %s: unknown setting" % ( section, key ) )
+                    continue
+                try:
+                    target[ key ] = self.parse( kinds[ key ][ 1 ], value )
+                except ValueError, e:
+                    errors.append( "[%s] %s: %s" % ( section, key, e ) )
+        errors.extend( self.check() )
+        if ( errors ):
+            raise ValueError( "\n   ".join( [ "Error in the config file " + path + ":" ] + errors ) )
+
+    def parse( self, kind, value ):
+        """ Convert the text of a setting to its type, ValueError when it doesn't fit
+        """
+        if ( kind == "str" ):
+            return value
+        if ( kind == "bool" ):
+            if ( value.lower() not in self.BOOLEANS ):
+                raise ValueError( "expected yes or no, got " + value )
+            return self.BOOLEANS[ value.lower() ]
+        if ( kind == "list" ):
+            return [ item.strip() for item in value.split( "," ) if item.strip() ]
+        if ( kind == "limit" and value.lower() in ( "", "none" ) ):
+            return None
+        if ( kind in ( "int", "float", "limit" ) ):
+            try:
+                number = float( value ) if kind == "float" else int( value )
+            except ValueError:
+                raise ValueError( "expected a number, got " + value )
+            if ( number < 0 ):
+                raise ValueError( "can't be negative" )
+            return number
+        if ( kind == "schedule" ):
+            # 08:00-18:00=2000000, 22:00-06:00=none
+            schedule = []
+            for item in self.parse( "list", value ):
+                try:
+                    hours, limit = item.split( "=" )
+                    start, end = [ part.strip() for part in hours.split( "-" ) ]
+                    time.strptime( start, "%H:%M" )
+                    time.strptime( end, "%H:%M" )
+                except ValueError:
+                    raise ValueError( "expected HH:MM-HH:MM=bytes per second, got " + item )
+                schedule.append( ( start, end, self.parse( "limit", limit.strip() ) ) )
+            return schedule
+        if ( kind == "intervals" ):
+            # upload=60, createSets=600
+            intervals = {}
+            for item in self.parse( "list", value ):
+                try:
+                    phase, seconds = [ part.strip() for part in item.split( "=" ) ]
+                except ValueError:
+                    raise ValueError( "expected phase=seconds, got " + item )
+                if ( phase not in DAEMON_INTERVALS ):
+                    raise ValueError( "unknown phase " + phase + ", expected one of " + ", ".join( sorted( DAEMON_INTERVALS ) ) )
+                intervals[ phase ] = self.parse( "int", seconds )
+            return intervals
+        raise ValueError( "unknown type " + kind )
+
+    def check( self ):
+        """ Problems the settings have together, as a list of messages
+        """
+        errors = []
+        if ( self.settings.get( "upload_order", UPLOAD_ORDER ) not in UploadScheduler.POLICIES ):
+            errors.append( "[uploadr] upload_order: expected one of " + ", ".join( UploadScheduler.POLICIES ) )
+        if ( self.settings.get( "api_workers", API_WORKERS ) < 1 ):
+            errors.append( "[uploadr] api_workers: at least 1 is needed" )
+        if ( self.roots and "files_dir" in self.settings ):
+            errors.append( "[uploadr] files_dir: not used along with [root NAME] sections, remove it" )
+        sections = [ ( "uploadr", self.settings ) ] + [ ( "root " + name, options ) for name, options in self.roots ]
+        for section, options in sections:
+            if ( options.get( "upload_workers", UPLOAD_WORKERS ) < 1 ):
+                errors.append( "[%s] upload_workers: at least 1 is needed" % section )
+            try:
+                options.get( "set_name", SET_NAME ).format( folder = "", parent = "", path = "", root = "" )
+            except ( KeyError, IndexError, ValueError ), e:
+                errors.append( "[%s] set_name: only {folder}, {parent}, {path} and {root} can be used (%s)" % ( section, e ) )
+        paths = []
+        for name, options in self.roots:
+            if ( "path" not in options ):
+                errors.append( "[root %s]: path is missing" % name )
+                continue
+            path = os.path.abspath( options[ "path" ] )
+            for other, otherPath in paths:
+                if ( path == otherPath or path.startswith( os.path.join( otherPath, "" ) ) or otherPath.startswith( os.path.join( path, "" ) ) ):
+                    errors.append( "[root %s]: %s overlaps with the path of [root %s]" % ( name, options[ "path" ], other ) )
+            paths.append( ( name, path ) )
+            if ( not os.path.isdir( path ) ):
+                self.warnings.append( "[root %s]: %s is not a directory (not mounted?), nothing will be uploaded from it" % ( name, options[ "path" ] ) )
+        return errors
+
+    def getGlobal( self, name ):
+        return Uploadr.TOKEN_FILE if name == "TOKEN_FILE" else globals()[ name ]
+
+    def setGlobal( self, name, value ):
+        if ( name == "TOKEN_FILE" ):
+            Uploadr.TOKEN_FILE = value
+        else:
+            globals()[ name ] = value
+
+    def apply( self ):
+        """ Make these settings the current ones: the globals and ROOTS
+        Settings no longer in the file go back to what this file says
+        """
+        names = [ name for name, kind in self.SETTINGS.values() + self.ROOT_SETTINGS.values() if name is not None ] + [ "FLICKR", "ROOTS" ]
+        if ( Config.defaults is None ):
+            Config.defaults = dict( ( name, copy.deepcopy( self.getGlobal( name ) ) ) for name in names )
+        for name in names:
+            self.setGlobal( name, copy.deepcopy( Config.defaults[ name ] ) )
+
+        for key, value in self.settings.items():
+            name = dict( self.SETTINGS, **self.ROOT_SETTINGS )[ key ][ 0 ]
+            if ( name is None ):
+                FLICKR[ key ] = value
+            elif ( name == "DAEMON_INTERVALS" ):
+                DAEMON_INTERVALS.update( value )
+            else:
+                self.setGlobal( name, value )
+        if ( "sleep_time" in self.settings and "upload" not in self.settings.get( "daemon_intervals", {} ) ):
+            DAEMON_INTERVALS[ "upload" ] = SLEEP_TIME
+        self.setGlobal( "ROOTS", [ Root( name, options[ "path" ], options ) for name, options in self.roots ] )
+
+        # Files that followed FILES_DIR follow the first root
+        base = Config.defaults[ "FILES_DIR" ]
+        first = ROOTS[ 0 ].path if ROOTS else FILES_DIR
+        for name, filename in self.DEFAULT_FILES:
+            key = name.lower()
+            if ( key not in self.settings and self.getGlobal( name ) == os.path.join( base, filename ) ):
+                self.setGlobal( name, os.path.join( first, filename ) )
+
+class ScanIndex:
+    """ ScanIndex class
+    The media tree as seen by the last scan. Folders whose mtime hasn't changed
+    since are not listed or stat'ed again, so the daemon keeps one ScanIndex
+    between cycles. A new ScanIndex does a full scan. Each folder keeps the
+    names of its entries packed in one string, sizes and mtimes in arrays.
+    """
+
+    # Sizes don't fit the 4 bytes of a long on 32 bit systems
+    SIZE_TYPE = "l" if array.array( "l" ).itemsize == 8 else "d"
+
+    def __init__( self ):
+        """ Constructor
+        """
+        self.dirs = {}                       # dirpath -> (mtime, sub folder names, file names, sizes, mtimes)
+
+    def scan( self, roots ):
+        """ Returns (path, size, mtime) for every file to upload below the roots
+        """
+        files = []
+        seen = set()
+        for root in roots:
+            stack = [ root.path ]
+            while ( stack ):
+                dirpath = stack.pop()
+                try:
+                    mtime = os.stat( dirpath ).st_mtime
+                except OSError:
+                    continue
+                seen.add( dirpath )
+                cached = self.dirs.get( dirpath )
+                if ( cached is None or cached[ 0 ] != mtime ):
+                    cached = ( mtime, ) + self.listDir( dirpath, root )
+                    self.dirs[ dirpath ] = cached
+                # Normalized like the paths in the db: "a/x.jpg", not "./a/x.jpg"
+                dirpath = os.path.normpath( dirpath )
+                prefix = "" if dirpath == os.curdir else os.path.join( dirpath, "" )
+                if ( cached[ 1 ] ):
+                    stack.extend( prefix + name for name in reversed( cached[ 1 ].split( "\0" ) ) )
+                if ( cached[ 2 ] ):
+                    files.extend( zip( [ prefix + name for name in cached[ 2 ].split( "\0" ) ], cached[ 3 ], cached[ 4 ] ) )
+        for dirpath in set( self.dirs ) - seen:
+            del self.dirs[ dirpath ]
+        return files
+
+    def listDir( self, dirpath, root ):
+        """ Sub folders to scan and files to upload of one folder, following the filters of its root
+        Returns (sub folder names, file names, sizes, mtimes), names joined with "\\0"
+        """
+        dirs = []
+        files = []
+        sizes = array.array( self.SIZE_TYPE )
+        mtimes = array.array( "d" )
+        try:
+            names = sorted( os.listdir( dirpath ) )
+        except OSError:
+            names = []
+        for f in names:
+            path = os.path.join( dirpath, f )
+            if ( os.path.isdir( path ) ):
+                if ( f not in root.excludedFolders ):
+                    dirs.append( f )
+                continue
+            ext = f.lower().split(".")[-1]
+            if ( ext in root.allowedExt ):
+                try:
+                    stat = os.stat( path )
+                except OSError:
+                    continue
+                if ( stat.st_size < root.fileMaxSize ):
+                    files.append( f )
+                    sizes.append( stat.st_size )
+                    mtimes.append( stat.st_mtime )
+        return "\0".join( dirs ), "\0".join( files ), sizes, mtimes
+
+class FileIndex:
+    """ FileIndex class
+    The files table of the db in memory, compact enough for libraries of
+    millions of files: folder prefixes are stored once, file names are packed
+    in one byte string, md5s as 16 raw bytes and the other columns in arrays.
+    Lookups by path, md5 and photo id go through open addressing tables of row
+    numbers, the md5 and photo id ones are built on first use. Rows are never
+    moved: a removed file leaves a hole, a moved one gets a new row. Stale
+    entries stay in the tables until a table gets half full and is built again.
+    save() writes the index with its tables to a snapshot file, restore()
+    reads it back and catches up with the changes logged in the file_changes
+    table of the db since (by triggers on the files table, see setupDB).
+    """
+
+    EMPTY = "\0" * 16
+    # Spreads runs of close hashes (photo ids are ints, their own hash) over the tables
+    SCRAMBLE = 40503
+    # Photo ids don't fit the 4 bytes of a long on 32 bit systems, doubles are exact up to 2**53
+    ID_TYPE = "l" if array.array( "l" ).itemsize == 8 else "d"
+    # Saved in this order by save(). A snapshot of another format, another
+    # platform or with hash randomization on is not used
+    COLUMNS = ( "prefix", "names", "ends", "hashes", "ids", "setIds", "tagged", "md5s" )
+    FORMAT = ( 1, hash( "FileIndex" ), ID_TYPE )
+
+    def __init__( self ):
+        """ Constructor, an empty index
+        """
+        self.lock = threading.Lock()
+        self.prefixes = []                   # folder prefix ("dir/") of each prefix number
+        self.prefixNumbers = {}
+        self.sets = []                       # set id of each set number
+        self.setNumbers = {}
+        self.prefix = array.array( "i" )     # prefix number of each row, -1 once removed
+        self.names = bytearray()
+        self.ends = array.array( "I" )       # the name of row is names[ends[row - 1]:ends[row]]
+        self.hashes = array.array( "I" )     # low 32 bits of the hash of the path of each row
+        self.ids = array.array( self.ID_TYPE )
+        self.setIds = array.array( "i" )     # set number of each row, -1 for none
+        self.tagged = array.array( "b" )
+        self.md5s = bytearray()
+        # Daemon only: size and mtime of each file when it was last found on Flickr as it is, -1 if not yet
+        self.sizes = None
+        self.mtimes = None
+        self.count = 0
+        self.tables = {}                     # "path", "id", "md5" -> [table, entries in it]
+        self.seq = 0                         # last change of the file_changes table in the index
+        self.savedSeq = None                 # seq of the last snapshot, None if there is none
+
+    @classmethod
+    def load( cls, con ):
+        """ Build the index of the files table in one streaming query
+        """
+        index = cls()
+        index.seq = cls.lastChange( con )
+        # Bound methods and locals: this loop runs once per file of the library
+        prefix, names, ends, hashes, ids, setIds, tagged, md5s = index.prefix.append, index.names.extend, index.ends.append, \
+            index.hashes.append, index.ids.append, index.setIds.append, index.tagged.append, index.md5s.extend
+        prefixNumber, setNumber = index.prefixNumbers.get, index.setNumbers.get
+        unhexlify, EMPTY = binascii.unhexlify, index.EMPTY
+        length = 0
+        for photoId, path, setId, md5, isTagged in con.execute( "SELECT files_id, path, set_id, md5, tagged IS 1 FROM files" ):
+            folder, sep, name = path.rpartition( "/" )
+            number = prefixNumber( folder + sep )
+            if ( number is None ):
+                number = index.number( folder + sep, index.prefixes, index.prefixNumbers )
+            prefix( number )
+            names( name )
+            length += len( name )
+            ends( length )
+            hashes( hash( path ) & 0xFFFFFFFF )
+            ids( photoId )
+            if ( setId is None ):
+                setIds( -1 )
+            else:
+                number = setNumber( setId )
+                setIds( index.number( setId, index.sets, index.setNumbers ) if number is None else number )
+            tagged( isTagged )
+            md5s( unhexlify( md5 ) if md5 else EMPTY )
+        index.count = len( index.prefix )
+        index.table( "path" )
+        return index
+
+    @classmethod
+    def restore( cls, con, path ):
+        """ The index saved to path by save(), brought up to date with the db.
+        None if there is no usable snapshot: missing, of another format or older
+        than the changes still logged in the db
+        """
+        try:
+            f = open( path, "rb" )
+        except IOError:
+            return None
+        with f:
+            try:
+                header = marshal.load( f )
+            except ( EOFError, ValueError, TypeError ):
+                return None
+            if ( not isinstance( header, dict ) or header.get( "format" ) != cls.FORMAT ):
+                return None
+            first = con.execute( "SELECT MIN(seq) FROM file_changes" ).fetchone()[ 0 ]
+            last = cls.lastChange( con )
+            if ( header[ "seq" ] > last or ( last + 1 if first is None else first ) > header[ "seq" ] + 1 ):
+                return None
+            index = cls()
+            try:
+                for name, length in zip( cls.COLUMNS, header[ "columns" ] ):
+                    column = getattr( index, name )
+                    if ( isinstance( column, bytearray ) ):
+                        column = bytearray( length )
+                        if ( f.readinto( column ) != length ):
+                            return None
+                        setattr( index, name, column )
+                    else:
+                        column.fromfile( f, length )
+                for name, length, entries in header[ "tables" ]:
+                    table = array.array( "i" )
+                    table.fromfile( f, length )
+                    index.tables[ name ] = [ table, entries ]
+            except EOFError:
+                return None
+        index.prefixes = header[ "prefixes" ]
+        index.prefixNumbers = dict( ( prefix, number ) for number, prefix in enumerate( index.prefixes ) )
+        index.sets = header[ "sets" ]
+        index.setNumbers = dict( ( setId, number ) for number, setId in enumerate( index.sets ) )
+        index.count = header[ "count" ]
+        index.seq = index.savedSeq = header[ "seq" ]
+        index.refresh( con )
+        return index
+
+    def save( self, path ):
+        """ Write the index and its built tables to path, for restore()
+        """
+        with self.lock:
+            columns = [ getattr( self, name ) for name in self.COLUMNS ]
+            tables = sorted( self.tables.items() )
+            header = {
+                "format"   : self.FORMAT,
+                "seq"      : self.seq,
+                "count"    : self.count,
+                "prefixes" : self.prefixes,
+                "sets"     : self.sets,
+                "columns"  : [ len( column ) for column in columns ],
+                "tables"   : [ ( name, len( table ), entries ) for name, ( table, entries ) in tables ]
+            }
+            # Written aside and renamed, a crash never leaves half a snapshot
+            with open( path + ".tmp", "wb" ) as f:
+                marshal.dump( header, f )
+                for column in columns + [ table for name, ( table, entries ) in tables ]:
+                    if ( isinstance( column, bytearray ) ):
+                        f.write( column )
+                    else:
+                        column.tofile( f )
+            os.rename( path + ".tmp", path )
+            self.savedSeq = self.seq
+
+    @staticmethod
+    def lastChange( con ):
+        """ seq of the last change logged in the file_changes table, 0 if none yet
+        """
+        try:
+            row = con.execute( "SELECT seq FROM sqlite_sequence WHERE name = 'file_changes'" ).fetchone()
+        except lite.OperationalError:
+            # A db setupDB hasn't seen yet
+            return 0
+        return row[ 0 ] if row else 0
+
+    def refresh( self, con ):
+        """ Take in the changes logged in the db since the index was made, by
+        this process or others. Returns the number of photo ids whose rows changed
+        """
+        seq = self.lastChange( con )
+        changed = {}
+        for ( photoId, ) in con.execute( "SELECT DISTINCT files_id FROM file_changes WHERE seq > ?", ( self.seq, ) ):
+            changed[ photoId ] = []
+        if ( changed ):
+            for row in con.execute( "SELECT files_id, path, set_id, md5, tagged IS 1 FROM files WHERE files_id IN "
+                    "(SELECT files_id FROM file_changes WHERE seq > ?)", ( self.seq, ) ):
+                changed.setdefault( row[ 0 ], [] ).append( row )
+        count = 0
+        for photoId, rows in changed.iteritems():
+            if ( photoId is None ):
+                continue
+            photoId = int( photoId )
+            old = [ row for row in self.probe( self.table( "id" ), hash( photoId ) ) if self.ids[ row ] == photoId and self.prefix[ row ] >= 0 ]
+            # The changes of this process are in the index already
+            if ( sorted( self.row( row ) for row in old ) == sorted( rows ) ):
+                continue
+            for row in old:
+                self.remove( row )
+            for row in rows:
+                self.add( *row )
+            count += 1
+        self.seq = seq
+        return count
+
+    def number( self, value, values, numbers ):
+        """ Number of an interned value (folder prefix or set id)
+        """
+        number = numbers.get( value )
+        if ( number is None ):
+            number = numbers[ value ] = len( values )
+            values.append( value )
+        return number
+
+    def table( self, name ):
+        """ Open addressing table name ("path", "id" or "md5"), built on first use
+        """
+        with self.lock:
+            if ( name not in self.tables ):
+                self.tables[ name ] = self.buildTable( getattr( self, name + "Hashes" )() )
+            return self.tables[ name ][ 0 ]
+
+    def buildTable( self, hashes ):
+        """ Open addressing table of the row numbers, from one hash per row (None to leave a row out)
+        Returns [table, number of entries]. The table is at most a third full, so
+        it takes at least half as many inserts again before it has to be rebuilt
+        """
+        size = 8
+        while ( size < 3 * self.count + 2 ):
+            size *= 2
+        table = array.array( "i", [ -1 ] ) * size
+        mask = size - 1
+        entries = 0
+        for row, h in enumerate( hashes ):
+            if ( h is None ):
+                continue
+            i = ( h * self.SCRAMBLE ) & mask
+            while ( table[ i ] >= 0 ):
+                i = ( i + 1 ) & mask
+            table[ i ] = row
+            entries += 1
+        return [ table, entries ]
+
+    def insert( self, name, h, row ):
+        """ Add row under hash h to table name if it's built, the caller holds the lock.
+        A table that would get more than half full is dropped, to be built again
+        without the stale entries: probing needs free slots to stop
+        """
+        built = self.tables.get( name )
+        if ( built is None ):
+            return
+        table, entries = built
+        if ( 2 * ( entries + 1 ) > len( table ) ):
+            del self.tables[ name ]
+            return
+        mask = len( table ) - 1
+        i = ( h * self.SCRAMBLE ) & mask
+        while ( table[ i ] >= 0 ):
+            i = ( i + 1 ) & mask
+        table[ i ] = row
+        built[ 1 ] = entries + 1
+
+    def probe( self, table, h ):
+        """ Rows stored under hash h, the caller checks they really match
+        """
+        mask = len( table ) - 1
+        i = ( h * self.SCRAMBLE ) & mask
+        while ( table[ i ] >= 0 ):
+            yield table[ i ]
+            i = ( i + 1 ) & mask
+
+    def pathHashes( self ):
+        return ( h if self.prefix[ row ] >= 0 else None for row, h in enumerate( self.hashes ) )
+
+    def idHashes( self ):
+        return ( hash( photoId ) if self.prefix[ row ] >= 0 else None for row, photoId in enumerate( self.ids ) )
+
+    def md5Hashes( self ):
+        md5s, prefix, EMPTY = self.md5s, self.prefix, self.EMPTY
+        for row in xrange( len( prefix ) ):
+            digest = str( md5s[ row * 16 : row * 16 + 16 ] )
+            yield hash( digest ) if prefix[ row ] >= 0 and digest != EMPTY else None
+
+    def __len__( self ):
+        return self.count
+
+    def __contains__( self, path ):
+        return self.find( path ) is not None
+
+    def find( self, path ):
+        """ Row of path, None if it isn't in the index
+        """
+        folder, sep, name = path.rpartition( "/" )
+        number = self.prefixNumbers.get( folder + sep )
+        if ( number is None ):
+            return None
+        # probe() inlined, the daemon looks up every file of the library in every cycle
+        built = self.tables.get( "path" )
+        table = self.table( "path" ) if built is None else built[ 0 ]
+        hashes, prefix, ends, names = self.hashes, self.prefix, self.ends, self.names
+        h = hash( path ) & 0xFFFFFFFF
+        mask = len( table ) - 1
+        i = ( h * self.SCRAMBLE ) & mask
+        row = table[ i ]
+        while ( row >= 0 ):
+            if ( hashes[ row ] == h and prefix[ row ] == number and names[ ends[ row - 1 ] if row else 0 : ends[ row ] ] == name ):
+                return row
+            i = ( i + 1 ) & mask
+            row = table[ i ]
+        return None
+
+    def findId( self, photoId ):
+        """ Row of a Flickr photo id, None if it isn't in the index
+        """
+        photoId = int( photoId )
+        for row in self.probe( self.table( "id" ), hash( photoId ) ):
+            if ( self.ids[ row ] == photoId and self.prefix[ row ] >= 0 ):
+                return row
+        return None
+
+    def findMd5( self, md5 ):
+        """ Rows of the files with this md5 (hex digest)
+        """
+        digest = binascii.unhexlify( md5 )
+        return [ row for row in self.probe( self.table( "md5" ), hash( digest ) ) if self.digest( row ) == digest and self.prefix[ row ] >= 0 ]
+
+    def name( self, row ):
+        return str( self.names[ self.ends[ row - 1 ] if row else 0 : self.ends[ row ] ] )
+
+    def path( self, row ):
+        return self.prefixes[ self.prefix[ row ] ] + self.name( row )
+
+    def digest( self, row ):
+        return str( self.md5s[ row * 16 : row * 16 + 16 ] )
+
+    def md5( self, row ):
+        """ Hex md5 of row, None if the db has none
+        """
+        digest = self.digest( row )
+        return None if digest == self.EMPTY else binascii.hexlify( digest )
+
+    def row( self, row ):
+        """ (files_id, path, set_id, md5, tagged) of row, as the files table has them
+        """
+        setNumber = self.setIds[ row ]
+        return ( int( self.ids[ row ] ), self.path( row ), None if setNumber < 0 else self.sets[ setNumber ], self.md5( row ), self.tagged[ row ] )
+
+    def rows( self ):
+        """ All the files, as rows of the files table
+        """
+        for row in xrange( len( self.prefix ) ):
+            if ( self.prefix[ row ] >= 0 ):
+                yield self.row( row )
+
+    def paths( self ):
+        """ (row, path) of all the files
+        """
+        prefixes, prefix, names, ends = self.prefixes, self.prefix, self.names, self.ends
+        start = 0
+        for row in xrange( len( prefix ) ):
+            end = ends[ row ]
+            if ( prefix[ row ] >= 0 ):
+                yield row, prefixes[ prefix[ row ] ] + str( names[ start:end ] )
+            start = end
+
+    def unassigned( self ):
+        """ Rows of the files without a set
+        """
+        prefix = self.prefix
+        return [ row for row, number in enumerate( self.setIds ) if number < 0 and prefix[ row ] >= 0 ]
+
+    def untagged( self ):
+        """ Rows of the files not tagged yet
+        """
+        prefix = self.prefix
+        return [ row for row, isTagged in enumerate( self.tagged ) if not isTagged and prefix[ row ] >= 0 ]
+
+    def add( self, photoId, path, setId = None, md5 = None, tagged = 0 ):
+        """ A file was added to the files table, returns its row
+        """
+        photoId = int( photoId )
+        folder, sep, name = path.rpartition( "/" )
+        with self.lock:
+            row = len( self.prefix )
+            self.prefix.append( self.number( folder + sep, self.prefixes, self.prefixNumbers ) )
+            self.names.extend( name )
+            self.ends.append( len( self.names ) )
+            self.hashes.append( hash( path ) & 0xFFFFFFFF )
+            self.ids.append( photoId )
+            self.setIds.append( -1 if setId is None else self.number( int( setId ), self.sets, self.setNumbers ) )
+            self.tagged.append( tagged == 1 )
+            self.md5s.extend( binascii.unhexlify( md5 ) if md5 else self.EMPTY )
+            if ( self.sizes is not None ):
+                self.sizes.append( -1 )
+                self.mtimes.append( -1 )
+            self.count += 1
+            self.insert( "path", self.hashes[ row ], row )
+            self.insert( "id", hash( photoId ), row )
+            if ( md5 ):
+                self.insert( "md5", hash( self.digest( row ) ), row )
+        return row
+
+    def remove( self, row ):
+        """ The file of row was removed from the files table
+        """
+        with self.lock:
+            if ( self.prefix[ row ] >= 0 ):
+                self.prefix[ row ] = -1
+                self.count -= 1
+
+    def move( self, row, path ):
+        """ The file of row now has path
+        """
+        photoId, old, setId, md5, tagged = self.row( row )
+        self.remove( row )
+        return self.add( photoId, path, setId, md5, tagged )
+
+    def setSet( self, row, setId ):
+        """ The file of row was added to a set (set ids are ints in the db, the API has them as strings)
+        """
+        with self.lock:
+            self.setIds[ row ] = -1 if setId is None else self.number( int( setId ), self.sets, self.setNumbers )
+
+    def setTagged( self, row ):
+        self.tagged[ row ] = 1
+
+    def setChecked( self, row, size, mtime ):
+        """ The file of row is on Flickr as it is with this size and mtime
+        """
+        with self.lock:
+            if ( self.sizes is None ):
+                self.sizes = array.array( "d", [ -1 ] ) * len( self.prefix )
+                self.mtimes = array.array( "d", [ -1 ] ) * len( self.prefix )
+            self.sizes[ row ] = size
+            self.mtimes[ row ] = mtime
+
+    def isChecked( self, row, size, mtime ):
+        """ True if the file of row was checked with this size and mtime
+        """
+        return self.sizes is not None and row is not None and self.sizes[ row ] == size and self.mtimes[ row ] == mtime
+
+    def copyChecked( self, index ):
+        """ Take over the checked sizes and mtimes of an older index of the same db
+        """
+        if ( index.sizes is None ):
+            return
+        for row, path in index.paths():
+            if ( index.sizes[ row ] >= 0 ):
+                found = self.find( path )
+                if ( found is not None ):
+                    self.setChecked( found, index.sizes[ row ], index.mtimes[ row ] )
+
+    def setMd5( self, row, md5 ):
+        """ The file of row was replaced by one with this md5
+        """
+        with self.lock:
+            self.md5s[ row * 16 : row * 16 + 16 ] = binascii.unhexlify( md5 )
+            self.insert( "md5", hash( self.digest( row ) ), row )
+
+class UploadScheduler:
+    """ UploadScheduler class
+    Decides in which order uploadFile() sees the files: files not in the db
+    first, priority folders first, then the order policy, with a share of the
+    slots kept for large files. The already uploaded ones only need an md5
+    check, they follow in the order they were found.
+    """
+
+    POLICIES = ( "newest", "smallest", "folders", "path" )
+
+    def __init__( self, policy = None, roots = None ):
+        """ Constructor, policy defaults to UPLOAD_ORDER, roots to FILES_DIR alone
+        """
+        self.policy = policy or UPLOAD_ORDER
+        if ( self.policy not in self.POLICIES ):
+            raise ValueError( "Unknown upload order: " + str( self.policy ) )
+        roots = roots or [ Root( "default", FILES_DIR ) ]
+        self.priorityDirs = [ os.path.join( os.path.normpath( os.path.join( root.path, folder ) ), "" ) for root in roots for folder in root.priorityFolders ]
+        self.largeSize = LARGE_FILE_SIZE
+        self.largeShare = LARGE_FILE_SHARE
+
+    def order( self, files, known ):
+        """ files is a sequence of (path, size, mtime), known the paths already in the db
+        Returns the paths in upload order
+        """
+        new = [ f for f in files if f[0] not in known ]
+        return [ f[0] for f in self.schedule( new ) ] + [ f[0] for f in files if f[0] in known ]
+
+    def schedule( self, files ):
+        """ Priority folders first (in the order they are listed), then everything else
+        """
+        groups = [ [] for folder in self.priorityDirs ] + [ [] ]
+        for f in files:
+            for i, folder in enumerate( self.priorityDirs ):
+                if ( f[0].startswith( folder ) ):
+                    groups[ i ].append( f )
+                    break
+            else:
+                groups[ -1 ].append( f )
+        result = []
+        for group in groups:
+            small = [ f for f in group if f[1] <= self.largeSize ]
+            large = [ f for f in group if f[1] > self.largeSize ]
+            result.extend( self.interleave( self.sort( small ), self.sort( large ) ) )
+        return result
+
+    def sort( self, files ):
+        """ Order files according to the policy
+        """
+        if ( self.policy == "newest" ):
+            return sorted( files, key = lambda f: ( -f[2], f[0] ) )
+        if ( self.policy == "smallest" ):
+            return sorted( files, key = lambda f: ( f[1], f[0] ) )
+        if ( self.policy == "folders" ):
+            folders = {}
+            for f in sorted( files ):
+                folders.setdefault( os.path.dirname( f[0] ), [] ).append( f )
+            queues = [ folders[ folder ] for folder in sorted( folders ) ]
+            return [ f for f in itertools.chain.from_iterable( itertools.izip_longest( *queues ) ) if f is not None ]
+        return sorted( files )
+
+    def interleave( self, small, large ):
+        """ Give large files largeShare of the slots while small files are waiting
+        """
+        result = []
+        credit = 0.0
+        i = j = 0
+        while ( i < len( small ) and j < len( large ) ):
+            credit += self.largeShare
+            if ( credit >= 1 ):
+                credit -= 1
+                result.append( large[ j ] )
+                j += 1
+            else:
+                result.append( small[ i ] )
+                i += 1
+        return result + small[ i: ] + large[ j: ]
+
+class Uploadr:
+    """ Uploadr class
+    """
+
+    token = None
+    perms = ""
+    profiler = None
+    # Warm state, only kept between the cycles of the daemon
+    db = None
+    dbThread = None
+    index = None
+    files = None
+    rememberChecked = False
+    setMap = None
+    reloadRequested = False
+    TOKEN_FILE = os.path.join(FILES_DIR, "flickrToken")
+
+    def __init__( self ):
+        """ Constructor
+        """
+        self.api = FlickrClient()
+        self.bandwidth = BandwidthLimiter()
+        self.leases = Leases()
+        self.lock = threading.Lock()
+        self.roots = ROOTS or [ Root( "default", FILES_DIR ) ]
+        self.token = self.getCachedToken()
+
+
+
+    def signCall( self, data):
+        """
+        Signs args via md5 per http://www.flickr.com/services/api/auth.spec.html (Section 8)
+        """
+        return self.api.signature( data )
+
     def urlGen( self , base,data, sig ):
         """ urlGen
         """
+        import urllib
         data['api_key'] = FLICKR[ "api_key" ]
         data['api_sig'] = sig
         encoded_url = base + "?" + urllib.urlencode( data )
@@ -225,10 +1795,8 @@ class Uploadr:
             "format"          : "json",
             "nojsoncallback"    : "1"
             }
-        sig = self.signCall( d )
-        url = self.urlGen( api.rest, d, sig )
         try:
-            response = self.getResponse( url )
+            response = self.api.call( d )
             if ( self.isGood( response ) ):
                 FLICKR[ "frob" ] = str(response["frob"]["_content"])
             else:
@@ -248,6 +1816,7 @@ class Uploadr:
         url = self.urlGen( api.auth, d, sig )
         ans = ""
         try:
+            import webbrowser
             webbrowser.open( url )
             print("Copy-paste following URL into a web browser and follow instructions:")
             print(url)
@@ -288,10 +1857,8 @@ class Uploadr:
             "format"          : "json",
             "nojsoncallback"    : "1"
         }
-        sig = self.signCall( d )
-        url = self.urlGen( api.rest, d, sig )
         try:
-            res = self.getResponse( url )
+            res = self.api.call( d )
             if ( self.isGood( res ) ):
                 self.token = str(res['auth']['token']['_content'])
                 self.perms = str(res['auth']['perms']['_content'])
@@ -346,11 +1913,8 @@ class Uploadr:
                 "format"          : "json",
                 "nojsoncallback"  : "1"
             }
-            sig = self.signCall( d )
-            
-            url = self.urlGen( api.rest, d, sig )
             try:
-                res = self.getResponse( url )
+                res = self.api.call( d )
                 if ( self.isGood( res ) ):
                     self.token = res['auth']['token']['_content']
                     self.perms = res['auth']['perms']['_content']
@@ -363,10 +1927,10 @@ class Uploadr:
 
     def removeDeletedMedia( self ):
         """ Remove files deleted at the local source
-        loop through database
-        check if file exists
-        if exists, continue
-        if not exists, delete photo from fickr
+        scan the local tree once and diff it against the database
+        if the batch is too large (disk not mounted?), abort
+        delete the batch from flickr concurrently
+        remove the deleted records and the sets they left empty from the local db
         http://www.flickr.com/services/api/flickr.photos.delete.html
         """
         
@@ -374,18 +1938,76 @@ class Uploadr:
         
         if ( not self.checkToken() ):
             self.authenticate()
-        con = lite.connect(DB_PATH)
-        con.text_factory = str
+        index = self.fileIndex()
+        con = self.connectDB()
         
         with con:
             cur = con.cursor()    
-            cur.execute("SELECT files_id, path FROM files")        
-            rows = cur.fetchall()
             
-            for row in rows:
-                if( not os.path.isfile(row[1])):
-                    success = self.deleteFile(row, cur)
+            deleted = self.findDeletedFiles( index, set( self.grabNewFiles() ) )
+            print("Found " + str(len(deleted)) + " deleted files")
+            
+            if ( self.tooManyDeletions( len(deleted), len(index) ) ):
+                print("Refusing to delete " + str(len(deleted)) + " of " + str(len(index)) + " files, is " + " and ".join(root.path for root in self.roots) + " mounted?")
+                print("Run again with --force-delete if these files are really gone.")
+                return
+            
+            self.deleteMedia( deleted, cur )
         print("*****Completed deleted files*****")
+
+    def findDeletedFiles( self, index, localFiles ):
+        """ Rows (files_id, path, set_id, md5, tagged) of the FileIndex whose file is gone
+        Only what the scan (localFiles) didn't find is stat'ed (excluded folders, grown files...)
+        Files outside the roots, or in a root that isn't there (not mounted?), are never deleted
+        """
+        present = [root for root in self.roots if os.path.isdir(root.path)]
+        return [index.row(row) for row, path in index.paths() if path not in localFiles and any(root.contains(path) for root in present) and not os.path.isfile(path)]
+
+    def rootOf( self, path ):
+        """ The root path is in, None if it isn't in any
+        """
+        for root in self.roots:
+            if ( root.contains(path) ):
+                return root
+        return None
+
+    def tooManyDeletions( self, count, total ):
+        """ True when deleting count of total files is more than MAX_DELETE_RATIO allows without --force-delete
+        """
+        return MAX_DELETE_RATIO > 0 and count > total * MAX_DELETE_RATIO and not args.force_delete
+
+    def deleteMedia( self, deleted, cur ):
+        """ Delete rows (files_id, path, set_id) from flickr concurrently, then
+        remove them and the sets they left empty from the local db
+        """
+        # Another process may have moved some of them meanwhile (see moveFile), they are not gone
+        current = []
+        for row in deleted:
+            cur.execute("SELECT files_id FROM files WHERE files_id = ? AND path = ?", (row[0], row[1]))
+            if ( cur.fetchone() is not None ):
+                current.append(row)
+        deleted = current
+        metrics.gauge("uploadr_queue_depth", len(deleted), queue="delete")
+        if ( len(deleted) == 0 ):
+            return
+        results = self.api.map( self.deleteFile, deleted )
+        gone = [row for row, success in zip(deleted, results) if success]
+        metrics.inc("uploadr_files_total", len(gone), action="deleted")
+        
+        # If you get 'attempt to write a readonly database', set 'admin' as owner of the DB file (fickerdb) and 'users' as group
+        cur.executemany("DELETE FROM files WHERE files_id = ? AND path = ?", [(row[0], row[1]) for row in gone])
+        for row in gone:
+            self.updateIndex("remove", row[1])
+        
+        # Remove the sets that lost their last file, one query for the whole batch
+        affectedSets = set(row[2] for row in gone if row[2] is not None)
+        cur.execute("SELECT DISTINCT set_id FROM files WHERE set_id IS NOT NULL")
+        emptySets = affectedSets - set(row[0] for row in cur.fetchall())
+        for setId in emptySets:
+            print("Set is empty, deleting the set ID: " + str(setId))
+        cur.executemany("DELETE FROM sets WHERE set_id = ?", [(setId,) for setId in emptySets])
+        if ( emptySets ):
+            self.setMap = None
     
     def upload( self ):
         """ upload
@@ -393,102 +2015,280 @@ class Uploadr:
         
         print("*****Uploading files*****")
         
-        allMedia = self.grabNewFiles()
+        index = self.fileIndex()
+        
+        start = time.time()
+        self.incomplete = False
+        # One lookup per file: the daemon skips the files already handled that look the same as then
+        files = []
+        known = set()
+        for f in self.scanFiles():
+            row = index.find(f[0])
+            if ( row is None ):
+                files.append(f)
+            elif ( not index.isChecked(row, f[1], f[2]) ):
+                files.append(f)
+                known.add(f[0])
+        allMedia = UploadScheduler(args.order, self.roots).order(files, known)
         print("Found " + str(len(allMedia)) + " files")
-        coun = 0;
-        for i, file in enumerate( allMedia ):
+        metrics.gauge("uploadr_queue_depth", len(allMedia), queue="upload")
+
+        # Sets and tags of the files uploaded meanwhile
+        uploading = threading.Event()
+        metadata = threading.Thread(target=self.updateMetadata, args=(uploading,))
+        metadata.daemon = True
+        metadata.start()
+
+        # One queue per root, worked on by as many threads as the root allows uploads at a time
+        self.processed = 0
+        self.queued = len(allMedia)
+        workers = []
+        for root in self.roots:
+            queue = collections.deque(path for path in allMedia if root.contains(path))
+            count = 1 if args.drip_feed else root.workers
+            workers += [threading.Thread(target=self.uploadQueue, args=(queue,)) for i in range(min(count, len(queue)))]
+        try:
+            if ( len(workers) == 1 ):
+                workers[0].run()
+            else:
+                for worker in workers:
+                    worker.start()
+                for worker in workers:
+                    worker.join()
+        finally:
+            uploading.set()
+            metadata.join()
+        if (self.processed%100 > 0):
+            print("   " + str(self.processed) + " files processed (uploaded or md5ed)")
+        metrics.gauge("uploadr_queue_depth", len(allMedia) - self.processed, queue="upload")
+        if ( not self.incomplete ):
+            # Every file is on Flickr as it was at start, see hasWork()
+            self.setState("last_check", start)
+        print("*****Completed uploading files*****")
+
+    def updateMetadata( self, done ):
+        """ Runs next to the upload workers until done is set: every METADATA_INTERVAL
+        seconds, the sets and tags of the files uploaded so far, so they don't wait
+        behind uploads that are throttled by the BandwidthLimiter
+        """
+
+        while ( not done.wait(METADATA_INTERVAL) ):
+            for phase in ("createSets", "addTagsToUploadedPhotos"):
+                try:
+                    self.runPhase(phase)
+                except Exception:
+                    print(str(sys.exc_info()))
+
+    def uploadQueue( self, queue ):
+        """ Upload worker: upload the files of queue until it's empty or uploads get paused
+        """
+
+        while ( queue ):
+            if ( self.bandwidth.paused() ):
+                print("Uploads are paused by BANDWIDTH_SCHEDULE, leaving the remaining files for later")
+                self.incomplete = True
+                return
+            try:
+                file = queue.popleft()
+            except IndexError:
+                return
             success = self.uploadFile( file )
-            if args.drip_feed and success and i != len( newFiles )-1:
+            with self.lock:
+                self.processed += 1
+                metrics.gauge("uploadr_queue_depth", self.queued - self.processed, queue="upload")
+                if (self.processed%100 == 0):
+                    print("   " + str(self.processed) + " files processed (uploaded or md5ed)")
+            if args.drip_feed and success and queue:
                 print("Waiting " + str(DRIP_TIME) + " seconds before next upload")
                 time.sleep( DRIP_TIME )
-            coun = coun + 1;
-            if (coun%100 == 0):
-                print("   " + str(coun) + " files processed (uploaded or md5ed)")
-        if (coun%100 > 0):
-            print("   " + str(coun) + " files processed (uploaded or md5ed)")
-        print("*****Completed uploading files*****")
 
     def grabNewFiles( self ): 
         """ grabNewFiles
         """
 
-        files = []
-        for dirpath, dirnames, filenames in os.walk( FILES_DIR, followlinks=True):
-            for curr_dir in EXCLUDED_FOLDERS:
-                if curr_dir in dirnames:
-                    dirnames.remove(curr_dir)
-            for f in filenames :
-                ext = f.lower().split(".")[-1]
-                if ext in ALLOWED_EXT:
-                    fileSize = os.path.getsize( dirpath + "/" + f )
-                    if (fileSize < FILE_MAX_SIZE):
-                        files.append( os.path.normpath( dirpath + "/" + f ) )
+        files = [f[0] for f in self.scanFiles()]
         files.sort()
         return files
 
+    def scanFiles( self ):
+        """ Walk the roots, returns (path, size, mtime) for every file to upload
+        The daemon reuses its ScanIndex, so only changed folders are listed again
+        """
+
+        with metrics.phase("scanFiles"):
+            return (self.index or ScanIndex()).scan(self.roots)
+
+    def fileIndex( self, refresh = False ):
+        """ The FileIndex of the db, loaded on first use and then kept up to date
+        as files are uploaded, moved, deleted, added to sets and tagged. It comes
+        from the snapshot next to the db when there is a usable one, the files
+        table is only read in full without. With refresh, the changes of other
+        processes are taken in (the daemon, with every full scan).
+        """
+
+        with self.lock:
+            if ( self.files is None or refresh ):
+                with metrics.phase("loadFileIndex"):
+                    con = self.connectDB()
+                    snapshot = DB_PATH + ".index"
+                    files = self.files
+                    if ( files is None ):
+                        files = FileIndex.restore(con, snapshot)
+                    else:
+                        files.refresh(con)
+                    # Removed and moved files leave holes, a full load packs the rows again
+                    if ( files is None or len(files.prefix) > 2 * len(files) + 1000 ):
+                        old, files = files, FileIndex.load(con)
+                        if ( old is not None ):
+                            files.copyChecked(old)
+                    if ( files.savedSeq is None or files.seq - files.savedSeq > len(files) // 16 ):
+                        try:
+                            files.save(snapshot)
+                        except ( IOError, OSError ), e:
+                            print("Warning: cannot save the file index: " + str(e))
+                        else:
+                            # Older snapshots (of other processes) can't catch up any more, they are loaded in full
+                            with con:
+                                con.execute("DELETE FROM file_changes WHERE seq <= ?", (files.seq,))
+                    self.closeDB(con)
+                    self.files = files
+            return self.files
+
+    def updateIndex( self, change, path, *values ):
+        """ Apply a change made to the files table (FileIndex method change) to the row of path
+        """
+
+        if ( self.files is not None ):
+            row = self.files.find(path)
+            if ( row is not None ):
+                getattr(self.files, change)(row, *values)
+
+    def remember( self, file ):
+        """ Daemon: file is in the db and on Flickr as it is now
+        """
+
+        if ( self.rememberChecked ):
+            index = self.fileIndex()
+            row = index.find(file)
+            if ( row is not None ):
+                stat = os.stat(file)
+                index.setChecked(row, stat.st_size, stat.st_mtime)
+
     def uploadFile( self, file ):
         """ uploadFile
+        Files claimed by another uploader process are skipped
+        """
+
+        if ( not self.leases.claim( "file:" + file ) ):
+            self.incomplete = True
+            return False
+        try:
+            return self.uploadClaimedFile( file )
+        finally:
+            self.leases.release( "file:" + file )
+
+    def uploadClaimedFile( self, file ):
+        """ Upload file, or replace it when it has changed since its upload
         """
 
         success = False
-        con = lite.connect(DB_PATH)
-        con.text_factory = str
+        con = self.connectDB()
         with con:
             cur = con.cursor()
             cur.execute("SELECT rowid,files_id,path,set_id,md5,tagged FROM files WHERE path = ?", (file,))
             row = cur.fetchone()
             
-            if(row is None):
+            fileMd5 = self.md5Checksum(file) if row is None else None
+            if(row is None and self.moveFile(file, fileMd5, cur)):
+                self.remember(file)
+            elif(row is None):
                 print("Uploading " + file + "...")
                 head, setName = os.path.split(os.path.dirname(file))
+                root = self.rootOf(file)
+                flickr = dict(root.flickr if root else FLICKR)
                 try:
-                    photo = ('photo', file, open(file,'rb').read())
                     if args.title: # Replace
-                        FLICKR["title"] = args.title
+                        flickr["title"] = args.title
                     if args.description: # Replace
-                        FLICKR["description"] = args.description
+                        flickr["description"] = args.description
                     if args.tags: # Append
-                        FLICKR["tags"] += " " + args.tags + " "
+                        flickr["tags"] += " " + args.tags + " "
                     d = {
                         "auth_token"    : str(self.token),
                         "perms"         : str(self.perms),
-                        "title"         : str( FLICKR["title"] ),
-                        "description"   : str( FLICKR["description"] ),
-                        "tags"          : str( FLICKR["tags"] + "," + setName ),
-                        "is_public"     : str( FLICKR["is_public"] ),
-                        "is_friend"     : str( FLICKR["is_friend"] ),
-                        "is_family"     : str( FLICKR["is_family"] )
+                        "title"         : str( flickr["title"] ),
+                        "description"   : str( flickr["description"] ),
+                        "tags"          : str( flickr["tags"] + "," + setName ),
+                        "is_public"     : str( flickr["is_public"] ),
+                        "is_friend"     : str( flickr["is_friend"] ),
+                        "is_family"     : str( flickr["is_family"] )
                     }
                     sig = self.signCall( d )
                     d[ "api_sig" ] = sig
                     d[ "api_key" ] = FLICKR[ "api_key" ]
-                    url = self.build_request(api.upload, d, (photo,))
-                    res = parse(urllib2.urlopen( url ))
+                    res = self.postMultipart(api.upload, d, file)
                     if ( not res == "" and res.documentElement.attributes['stat'].value == "ok" ):
                         print("Successfully uploaded the file: " + file)
+                        metrics.inc("uploadr_files_total", action="uploaded")
+                        metrics.inc("uploadr_upload_bytes_total", os.path.getsize(file))
                         # Add to set
-                        cur.execute('INSERT INTO files (files_id, path, md5, tagged) VALUES (?, ?, ?, 1)',(int(str(res.getElementsByTagName('photoid')[0].firstChild.nodeValue)), file, self.md5Checksum(file)))
+                        photoId = int(str(res.getElementsByTagName('photoid')[0].firstChild.nodeValue))
+                        cur.execute('INSERT INTO files (files_id, path, md5, tagged) VALUES (?, ?, ?, 1)',(photoId, file, fileMd5))
+                        self.fileIndex().add(photoId, file, None, fileMd5, 1)
+                        self.remember(file)
                         success = True
                     else :
+                        metrics.inc("uploadr_files_total", action="failed")
+                        self.incomplete = True
                         print("A problem occurred while attempting to upload the file: " + file)
                         try:
                             print("Error: " + str( res.toxml() ))
                         except:
                             print("Error: " + str( res.toxml() ))
                 except:
+                    metrics.inc("uploadr_files_total", action="failed")
+                    self.incomplete = True
                     print(str(sys.exc_info()))
             elif (MANAGE_CHANGES):
+                metrics.inc("uploadr_files_total", action="checked")
                 fileMd5 = self.md5Checksum(file)
-                if (fileMd5 != str(row[4])):
-                    self.replacePhoto(file, row[1], fileMd5, cur, con);
+                if (fileMd5 == str(row[4]) or self.replacePhoto(file, row[1], fileMd5, cur, con)):
+                    self.remember(file)
+                else:
+                    self.incomplete = True
+            else:
+                self.remember(file)
             return success
                         
+    def moveFile( self, file, fileMd5, cur ):
+        """ file isn't in the db yet. If a file with the same md5 is gone from its
+        place, file is that one moved: only its path changes, nothing is uploaded
+        Returns True for a move. A photo that changes set is taken out of its old one
+        """
+        index = self.fileIndex()
+        present = [root for root in self.roots if os.path.isdir(root.path)]
+        for row in index.findMd5(fileMd5):
+            photoId, old, oldSetId, md5, tagged = index.row(row)
+            if ( os.path.isfile(old) or not any(root.contains(old) for root in present) ):
+                continue
+            setId = oldSetId
+            if ( self.setName(old) != self.setName(file) ):
+                # createSets adds it to the set of its new folder
+                setId = None
+            cur.execute("UPDATE files SET path = ?, set_id = ? WHERE files_id = ? AND path = ?", (file, setId, photoId, old))
+            if ( cur.rowcount == 1 ):
+                print("Moved " + old + " to " + file)
+                metrics.inc("uploadr_files_total", action="moved")
+                index.setSet(index.move(row, file), setId)
+                if ( oldSetId is not None and setId is None ):
+                    self.removeFileFromSet(oldSetId, photoId)
+                return True
+        return False
+
     def replacePhoto ( self, file, file_id, fileMd5, cur, con ) :
         success = False
         print("Replacing the file: " + file + "...")
         try:
-            photo = ('photo', file, open(file,'rb').read())
-    
             d = {
                 "auth_token"    : str(self.token),
                 "photo_id"     : str( file_id )
@@ -496,13 +2296,15 @@ class Uploadr:
             sig = self.signCall( d )
             d[ "api_sig" ] = sig
             d[ "api_key" ] = FLICKR[ "api_key" ]
-            url = self.build_request(api.replace, d, (photo,))
-            res = parse(urllib2.urlopen( url ))
+            res = self.postMultipart(api.replace, d, file)
             if ( not res == "" and res.documentElement.attributes['stat'].value == "ok" ):
                 print("Successfully replaced the file: " + file)
+                metrics.inc("uploadr_files_total", action="replaced")
+                metrics.inc("uploadr_upload_bytes_total", os.path.getsize(file))
                 # Add to set
                 cur.execute('UPDATE files SET md5 = ? WHERE files_id = ?',(fileMd5, file_id))
                 con.commit()
+                self.updateIndex("setMd5", file, fileMd5)
                 success = True
             else :
                 print("A problem occurred while attempting to replace the file: " + file)
@@ -515,7 +2317,11 @@ class Uploadr:
         
         return success
 
-    def deleteFile( self, file, cur ):
+    def deleteFile( self, file ):
+        """ Delete a photo from Flickr
+        Returns True once the photo is gone (also if it was already removed),
+        updating the local db is left to the caller
+        """
         success = False
         print("Deleting file: " + str(file[1]))
         
@@ -529,32 +2335,17 @@ class Uploadr:
                 "format"          : "json",
                 "nojsoncallback"  : "1"
             }
-            sig = self.signCall( d )
-            url = self.urlGen( api.rest, d, sig )
-            res = self.getResponse( url )
+            res = self.api.call( d )
             if ( self.isGood( res ) ):
-                
-                # Find out if the file is the last item in a set, if so, remove the set from the local db
-                cur.execute("SELECT set_id FROM files WHERE files_id = ?", (file[0],))
-                row = cur.fetchone()
-                cur.execute("SELECT set_id FROM files WHERE set_id = ?", (row[0],))
-                rows = cur.fetchall()
-                if(len(rows) == 1):
-                    print("File is the last of the set, deleting the set ID: " + str(row[0]))
-                    cur.execute("DELETE FROM sets WHERE set_id = ?", (row[0],))
-               
-                # Delete file record from the local db
-                cur.execute("DELETE FROM files WHERE files_id = ?", (file[0],))
                 print("Successful deletion.")
                 success = True
             else :
                 if( res['code'] == 1 ):
                     # File already removed from Flicker
-                    cur.execute("DELETE FROM files WHERE files_id = ?", (file[0],)) 
+                    success = True
                 else :
                     self.reportError( res )
         except:
-            # If you get 'attempt to write a readonly database', set 'admin' as owner of the DB file (fickerdb) and 'users' as group
             print(str(sys.exc_info()))
         return success               
 
@@ -565,8 +2356,29 @@ class Uploadr:
         cur.execute("INSERT INTO sets (set_id, name, primary_photo_id) VALUES (?,?,?)", (setId,setName,primaryPhotoId))        
         cur.execute("UPDATE files SET set_id = ? WHERE files_id = ?", (setId, primaryPhotoId)) 
         con.commit()
+        if ( self.files is not None ):
+            row = self.files.findId(primaryPhotoId)
+            if ( row is not None ):
+                self.files.setSet(row, setId)
+        if ( self.setMap is not None ):
+            self.setMap[setName] = setId
+            self.setMapRows += 1
         return True
 
+    def loadSetMap( self, cur ):
+        """ Set name -> set id. The daemon keeps the map between cycles and only
+        reloads it when the sets table changed behind its back (other process)
+        """
+        cur.execute("SELECT count(*) FROM sets")
+        rows = cur.fetchone()[0]
+        if ( self.setMap is None or self.setMapRows != rows ):
+            self.setMap = {}
+            self.setMapRows = rows
+            cur.execute("SELECT set_id, name FROM sets")
+            for row in cur.fetchall():
+                self.setMap.setdefault(row[1], row[0])
+        return self.setMap
+
     def build_request(self, theurl, fields, files, txheaders=None):
         """
         build_request/encode_multipart_formdata code is from www.voidspace.org.uk/atlantibots/pythonutils.html
@@ -577,6 +2389,7 @@ class Uploadr:
         files is a sequence of (name, filename, value) elements for data to be uploaded as files.
         """
 
+        import urllib2
         content_type, body = self.encode_multipart_formdata(fields, files)
         if not txheaders: txheaders = {}
         txheaders['Content-type'] = content_type
@@ -584,7 +2397,49 @@ class Uploadr:
 
         return urllib2.Request(theurl, body, txheaders)
 
-    def encode_multipart_formdata(self,fields, files, BOUNDARY = '-----'+mimetools.choose_boundary()+'-----'):
+    def postMultipart( self, theurl, fields, file ):
+        """ POST fields and the photo through the API client and parse the XML answer
+        The photo is streamed from disk at the rate self.bandwidth allows.
+        Uploads are not retried, a retry could create a duplicate photo
+        """
+
+        from xml.dom.minidom import parseString
+        content_type, body = self.encode_multipart_stream(fields, 'photo', file)
+        try:
+            return parseString(self.api.send("POST", theurl, body, {'Content-type': content_type, 'Content-length': str(len(body))}, retries=0))
+        finally:
+            body.close()
+
+    def encode_multipart_stream(self, fields, key, filename):
+        """ Same as encode_multipart_formdata for a single file, but the body
+        returned is a MultipartBody reading the file as it is sent.
+        Return (content_type, body) ready for FlickrClient.send
+        """
+
+        import mimetools
+        import mimetypes
+        BOUNDARY = '-----'+mimetools.choose_boundary()+'-----'
+        CRLF = '\r\n'
+        L = []
+        if isinstance(fields, dict):
+            fields = fields.items()
+        for (k, value) in fields:
+            L.append('--' + BOUNDARY)
+            L.append('Content-Disposition: form-data; name="%s"' % k)
+            L.append('')
+            L.append(value)
+        filetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        L.append('--' + BOUNDARY)
+        L.append('Content-Disposition: form-data; name="%s"; filename="%s"' % (key, filename))
+        L.append('Content-Type: %s' % filetype)
+        L.append('')
+        L.append('')
+        head = CRLF.join(L)
+        tail = CRLF + '--' + BOUNDARY + '--' + CRLF
+        content_type = 'multipart/form-data; boundary=%s' % BOUNDARY
+        return content_type, MultipartBody(head, filename, tail, self.bandwidth)
+
+    def encode_multipart_formdata(self,fields, files, BOUNDARY = None):
         """ Encodes fields and files for uploading.
         fields is a sequence of (name, value) elements for regular form fields - or a dictionary.
         files is a sequence of (name, filename, value) elements for data to be uploaded as files.
@@ -592,6 +2447,9 @@ class Uploadr:
         You can optionally pass in a boundary string to use or we'll let mimetools provide one.
         """
 
+        import mimetools
+        import mimetypes
+        BOUNDARY = BOUNDARY or '-----'+mimetools.choose_boundary()+'-----'
         CRLF = '\r\n'
         L = []
         if isinstance(fields, dict):
@@ -637,52 +2495,146 @@ class Uploadr:
         Send the url and get a response.  Let errors float up
         """
         
+        return self.api.get( url )
+
+    def runPhase( self, name, exclusive = True ):
+        """ Run one phase (a method name), timing it and profiling it with --profile.
+        Exclusive phases are skipped when another uploader process is already running them
+        """
+
+        if ( exclusive and not self.leases.claim( "phase:" + name ) ):
+            print("*****Skipping " + name + ", another uploader is running it*****")
+            return
         try:
-            res = urllib2.urlopen( url ).read()
-        except urllib2.HTTPError, e:
-            print(e.code)
-        except urllib2.URLError, e:
-            print(e.args)
-        return json.loads(res)
+            with metrics.phase( name ):
+                if ( self.profiler is None ):
+                    getattr( self, name )()
+                else:
+                    with self.profiler.phase( name ):
+                        getattr( self, name )()
+        finally:
+            if ( exclusive ):
+                self.leases.release( "phase:" + name )
 
     def run( self ):
         """ run
+        Daemon: every phase runs on its own DAEMON_INTERVALS schedule. The db
+        connection, the scan index, the FileIndex and the set map stay
+        warm between cycles, so a cycle only costs what changed. SIGHUP
+        reloads the configuration.
         """
 
+        phases = ["removeUselessSetsTable", "getFlickrSets", "upload", "removeDeletedMedia", "createSets", "addTagsToUploadedPhotos"]
+        signal.signal(signal.SIGHUP, self.requestReload)
+        self.warmUp()
+        lastRun = {}
+        lastFullScan = time.time()
         while ( True ):
-            self.upload()
+            if ( self.reloadRequested ):
+                self.reloadConfig()
+                lastRun = {}
+            if ( time.time() - lastFullScan >= DAEMON_FULL_SCAN ):
+                self.index = ScanIndex()
+                # For the changes of other processes
+                self.fileIndex(refresh=True)
+                lastFullScan = time.time()
+            for phase in phases:
+                if ( time.time() - lastRun.get(phase, 0) >= DAEMON_INTERVALS[phase] ):
+                    self.runPhase(phase, exclusive=(phase != "upload"))
+                    lastRun[phase] = time.time()
+            metrics.write()
+            if ( self.profiler is not None ):
+                self.profiler.write()
             print("Last check: " + str( time.asctime(time.localtime())))
-            time.sleep( SLEEP_TIME )
+            # A SIGHUP cuts the sleep short
+            wait = min(lastRun[phase] + DAEMON_INTERVALS[phase] for phase in phases) - time.time()
+            if ( wait > 0 and not self.reloadRequested ):
+                time.sleep( wait )
+
+    def warmUp( self ):
+        """ Daemon: open the connection and the caches kept between cycles
+        """
+
+        self.db = None
+        self.db = self.connectDB()
+        self.dbThread = threading.current_thread()
+        self.index = ScanIndex()
+        self.rememberChecked = True
+        self.setMap = None
+        if ( not self.checkToken() ):
+            self.authenticate()
+
+    def requestReload( self, signum, frame ):
+        """ SIGHUP handler, the reload happens between two phases
+        """
+
+        print("SIGHUP received, reloading the configuration")
+        self.reloadRequested = True
+
+    def reloadConfig( self ):
+        """ Read the config file again, drop the warm state and start over with
+        the new configuration, keeping the FileIndex if the db is the same. A
+        config file with errors is ignored.
+        """
+
+        self.reloadRequested = False
+        if ( os.path.exists(CONFIG_FILE) ):
+            try:
+                config = Config(CONFIG_FILE)
+            except ValueError, e:
+                print(str(e))
+                print("Keeping the current configuration")
+                return
+            for warning in config.warnings:
+                print("Warning: " + warning)
+            dbPath = DB_PATH
+            config.apply()
+            # The FileIndex (and what was checked) still holds for the same db
+            if ( DB_PATH != dbPath ):
+                self.files = None
+        self.db.close()
+        self.db = None
+        # The leases may be in another db now
+        self.leases.close()
+        self.leases = Leases()
+        self.setupDB()
+        self.roots = ROOTS or [ Root( "default", FILES_DIR ) ]
+        self.api.close()
+        self.api = FlickrClient()
+        self.bandwidth = BandwidthLimiter()
+        self.token = self.getCachedToken()
+        self.warmUp()
+        if ( self.files is not None ):
+            self.fileIndex(refresh=True)
+        print("Configuration reloaded")
     
     def createSets( self ):
         print('*****Creating Sets*****')
         
-        con = lite.connect(DB_PATH)
-        con.text_factory = str
+        con = self.connectDB()
         with con:    
     
             cur = con.cursor()    
-            cur.execute("SELECT files_id, path, set_id FROM files")
+            # Only files without a (known) set have anything to do
+            cur.execute("SELECT files_id, path, set_id FROM files WHERE set_id IS NULL OR set_id NOT IN (SELECT set_id FROM sets)")
 
             files = cur.fetchall()
+            setMap = self.loadSetMap(cur)
         
             for row in files:
-                head, setName = os.path.split(os.path.dirname(row[1]))
+                setName = self.setName(row[1])
                 newSetCreated = False
                 
-                cur.execute("SELECT set_id, name FROM sets WHERE name = ?", (setName,))
-            
-                set = cur.fetchone()
+                setId = setMap.get(setName)
                 
-                if set == None:
+                if setId == None:
                     setId = self.createSet(setName, row[0], cur, con)  
                     print("Created the set: " + setName)
                     newSetCreated = True                  
-                else :
-                    setId = set[0]
                     
                 if row[2] == None and newSetCreated == False :
                     self.addFileToSet(setId, row, cur)
+                    con.commit()
         print('*****Completed creating sets*****')
     
     def addFileToSet( self, setId, file, cur):
@@ -696,28 +2648,48 @@ class Uploadr:
                 "photoset_id"         : str( setId ),
                 "photo_id"            : str( file[0] )
             }
-            sig = self.signCall( d )
-            url = self.urlGen( api.rest, d, sig )
-            
-            res = self.getResponse( url )
+            res = self.api.call( d )
             if ( self.isGood( res ) ):
             
                 print("Successfully added file " + str(file[1]) + " to its set.")
                 
                 cur.execute("UPDATE files SET set_id = ? WHERE files_id = ?", (setId, file[0]))        
+                self.updateIndex("setSet", file[1], setId)
                         
             else :
                 if ( res['code'] == 1 ) :
                     print("Photoset not found, creating new set...")
-                    head, setName = os.path.split(os.path.dirname(file[1]))
-                    con = lite.connect(DB_PATH)
-                    con.text_factory = str
+                    setName = self.setName(file[1])
+                    con = self.connectDB()
                     self.createSet( setName, file[0], cur, con)
                 else :
                     self.reportError( res )
         except:
             print(str(sys.exc_info()))
 
+    def removeFileFromSet( self, setId, photoId ):
+        """ Take a photo out of a set on Flickr (its file moved to another folder)
+        Returns True once it isn't in the set, also when the set or the photo is gone
+        """
+        print("Removing photo " + str(photoId) + " from set " + str(setId))
+        try:
+            d = {
+                "auth_token"          : str(self.token),
+                "perms"               : str(self.perms),
+                "format"              : "json",
+                "nojsoncallback"      : "1",
+                "method"              : "flickr.photosets.removePhoto",
+                "photoset_id"         : str( setId ),
+                "photo_id"            : str( photoId )
+            }
+            res = self.api.call( d )
+            if ( self.isGood( res ) or res['code'] in ( 1, 2 ) ):
+                return True
+            self.reportError( res )
+        except:
+            print(str(sys.exc_info()))
+        return False
+
     def createSet( self, setName, primaryPhotoId, cur, con):
         print("Creating new set: " + str(setName))
         
@@ -733,11 +2705,7 @@ class Uploadr:
             
             }
 
-
-            sig = self.signCall( d )
-
-            url = self.urlGen( api.rest, d, sig )
-            res = self.getResponse( url )
+            res = self.api.call( d )
             if ( self.isGood( res ) ):
                 self.logSetCreation( res["photoset"]["id"], setName, primaryPhotoId, cur, con )
                 return res["photoset"]["id"]
@@ -748,27 +2716,74 @@ class Uploadr:
             print(str(sys.exc_info()))
         return False
             
+    def connectDB ( self ):
+        """ Open the database, waiting for other uploader processes instead of failing when it's locked
+        The daemon keeps one connection open instead, for its main thread
+        """
+        if ( self.db is not None and threading.current_thread() is self.dbThread ):
+            return self.db
+        con = lite.connect(DB_PATH, timeout=LEASE_TIME)
+        con.text_factory = str
+        return con
+
+    def closeDB ( self, con ):
+        """ Close a connection from connectDB, unless it's the one the daemon keeps open
+        """
+        if ( con is not self.db ):
+            con.close()
+
     def setupDB ( self ):
         print("Setting up the database: " + DB_PATH)
         con = None
         try:
-            con = lite.connect(DB_PATH)
-            con.text_factory = str
+            con = self.connectDB()
             cur = con.cursor() 
+            if DB_WAL:
+                cur.execute('PRAGMA journal_mode=WAL')
             cur.execute('create table if not exists files (files_id int, path text, set_id int, md5 text, tagged int)')
             cur.execute('create table if not exists sets (set_id int, name text, primary_photo_id INTEGER)')
+            cur.execute('create table if not exists leases (item text primary key, owner text, expires real)')
+            cur.execute('create table if not exists state (name text primary key, value)')
+            # Every change to files is logged, for FileIndex snapshots to catch up with
+            cur.execute('create table if not exists file_changes (seq integer primary key autoincrement, files_id int)')
+            cur.execute('create trigger if not exists files_inserted after insert on files begin '
+                'insert into file_changes (files_id) values (new.files_id); end')
+            cur.execute('create trigger if not exists files_updated after update on files begin '
+                'insert into file_changes (files_id) values (old.files_id); '
+                'insert into file_changes (files_id) select new.files_id where new.files_id is not old.files_id; end')
+            cur.execute('create trigger if not exists files_deleted after delete on files begin '
+                'insert into file_changes (files_id) values (old.files_id); end')
             con.commit()
-            con.close()
+            self.closeDB(con)
         except lite.Error, e:
             print("Error: %s" % e.args[0])
             if con != None:
-                con.close()
+                self.closeDB(con)
             sys.exit(1)
         finally:
             print("Completed database setup")
+
+    def getState( self, name ):
+        """ Value saved in the state table of the db, None if there is none
+        """
+        con = self.connectDB()
+        with con:
+            cur = con.cursor()
+            cur.execute("SELECT value FROM state WHERE name = ?", (name,))
+            row = cur.fetchone()
+        self.closeDB(con)
+        return row[0] if row else None
+
+    def setState( self, name, value ):
+        """ Save a value in the state table of the db
+        """
+        con = self.connectDB()
+        with con:
+            con.execute("INSERT OR REPLACE INTO state (name, value) VALUES (?, ?)", (name, value))
+        self.closeDB(con)
                 
     def md5Checksum(self, filePath):
-        with open(filePath, 'rb') as fh:
+        with metrics.phase("md5Checksum"), open(filePath, 'rb') as fh:
             m = hashlib.md5()
             while True:
                 data = fh.read(8192)
@@ -780,28 +2795,32 @@ class Uploadr:
     def addTagsToUploadedPhotos ( self ) :
         print('*****Adding tags to existing photos*****')
         
-        con = lite.connect(DB_PATH)
-        con.text_factory = str
+        con = self.connectDB()
 
         with con:    
     
             cur = con.cursor()    
-            cur.execute("SELECT files_id, path, set_id, tagged FROM files")
+            cur.execute("SELECT files_id, path, set_id, tagged FROM files WHERE tagged IS NOT 1")
 
             files = cur.fetchall()
+            metrics.gauge("uploadr_queue_depth", len(files), queue="tag")
+            results = self.api.map(self.addTagToPhoto, files)
+            metrics.inc("uploadr_files_total", results.count(True), action="tagged")
             
-            for row in files:
-                if(row[3] != 1) :
-                    head, setName = os.path.split(os.path.dirname(row[1]))
-                    
-                    status = self.addTagToPhoto(row, setName, cur, con)
-                    
-                    if status == False:
-                        print("Error: cannot add tag to file: " + file[1])
+            for row, status in zip(files, results):
+                if status == False:
+                    print("Error: cannot add tag to file: " + row[1])
+            cur.executemany("UPDATE files SET tagged=? WHERE files_id=?", [(1, row[0]) for row, status in zip(files, results) if status])
+            for row, status in zip(files, results):
+                if status:
+                    self.updateIndex("setTagged", row[1])
                                          
         print('*****Completed adding tags*****')
     
-    def addTagToPhoto(self, file, tagName, cur, con) :
+    def addTagToPhoto(self, file) :
+        """ Tag a photo with the name of its folder, updating the local db is left to the caller
+        """
+        head, tagName = os.path.split(os.path.dirname(file[1]))
         print("Adding tag " + tagName + " to photo: " + str(file[1]) + " (" + str(file[0]) + ")")
         
         try:
@@ -814,13 +2833,8 @@ class Uploadr:
                 "photo_id"          : str( file[0] ),
                 "tags"               : tagName
             }
-            sig = self.signCall( d )
-            url = self.urlGen( api.rest, d, sig )
-       
-            res = self.getResponse( url )
+            res = self.api.call( d )
             if ( self.isGood( res ) ):
-                cur.execute("UPDATE files SET tagged=? WHERE files_id=?", (1, file[0]))
-                con.commit()
                 return True
             else :
                 print(d)
@@ -833,8 +2847,7 @@ class Uploadr:
     def removeUselessSetsTable( self ) :
         print('*****Removing empty Sets from DB*****')
         
-        con = lite.connect(DB_PATH)
-        con.text_factory = str
+        con = self.connectDB()
         with con:    
     
             cur = con.cursor()
@@ -845,13 +2858,14 @@ class Uploadr:
                 print("Unused set spotted about to be deleted:" + str(row[0]) + "(" + row[1] + ")")
                 cur.execute("DELETE FROM sets WHERE set_id = ?", (row[0],))
             con.commit()
+            if ( unusedsets ):
+                self.setMap = None
 
         print('*****Completed removing empty Sets from DB*****')
     
     # Display Sets
     def displaySets( self ) :
-        con = lite.connect(DB_PATH)
-        con.text_factory = str
+        con = self.connectDB()
         with con:    
             cur = con.cursor()
             cur.execute("SELECT set_id, name FROM sets")
@@ -862,8 +2876,7 @@ class Uploadr:
     # Get sets from Flickr
     def getFlickrSets(self):
         print('*****Adding Flickr Sets to DB*****')
-        con = lite.connect(DB_PATH)
-        con.text_factory = str
+        con = self.connectDB()
         try:
             d = {
                 "auth_token"          : str(self.token),
@@ -872,8 +2885,7 @@ class Uploadr:
                 "nojsoncallback"      : "1",
                 "method"              : "flickr.photosets.getList"
             }
-            url = self.urlGen(api.rest, d, self.signCall(d))
-            res = self.getResponse(url)
+            res = self.api.call(d)
             if (self.isGood(res)):
                 cur = con.cursor()
                 for row in res['photosets']['photoset']:
@@ -886,7 +2898,7 @@ class Uploadr:
                         print("   Adding set ", setId, setName, primaryPhotoId)
                         cur.execute("INSERT INTO sets (set_id, name, primary_photo_id) VALUES (?,?,?)", (setId, setName, primaryPhotoId))
                 con.commit()
-                con.close()
+                self.closeDB(con)
             else:
                 print(d)
                 self.reportError(res)
@@ -894,16 +2906,246 @@ class Uploadr:
             print(str(sys.exc_info()))
         print('*****Completed adding Flickr Sets to DB*****')
 
-print("--------- Start time: " + time.strftime("%c") + " ---------");
+    def setName( self, path ):
+        """ Name of the set a file belongs to, following the set_name of its root
+        Files outside the roots go to the set named after their folder
+        """
+        root = self.rootOf(path)
+        if ( root is None ):
+            head, setName = os.path.split(os.path.dirname(path))
+            return setName
+        return root.setName(path)
+
+    def hasWork( self ):
+        """ Local check before a one-off run, without any network call: False when
+        nothing changed since the last upload phase that went through. Files
+        changed in place are noticed by their mtime.
+        """
+        lastCheck = self.getState("last_check")
+        if ( lastCheck is None ):
+            return True
+        files = self.scanFiles()
+        con = self.connectDB()
+        with con:
+            cur = con.cursor()
+            cur.execute("SELECT 1 FROM files WHERE set_id IS NULL OR tagged IS NOT 1 LIMIT 1")
+            unfinished = cur.fetchone() is not None
+        self.closeDB(con)
+        if ( unfinished ):
+            return True
+
+        # The run goes on with the same FileIndex when there is work
+        known = self.fileIndex()
+        if ( any(f[0] not in known or (MANAGE_CHANGES and f[2] >= lastCheck) for f in files) ):
+            return True
+        return len(self.findDeletedFiles(known, set(f[0] for f in files))) > 0
+
+    def makePlan( self ):
+        """ Work out what a run would do without any network call: scan the
+        tree and diff it against the db. Returns the plan as a dict (see --plan)
+        """
+        files = self.scanFiles()
+        index = self.fileIndex()
+        con = self.connectDB()
+        with con:
+            cur = con.cursor()
+            cur.execute("SELECT name FROM sets")
+            setNames = set(row[0] for row in cur.fetchall())
+        self.closeDB(con)
+
+        local = dict((f[0], f) for f in files)
+        new = [local[path] for path in UploadScheduler(args.order, self.roots).order(files, index) if path not in index]
+        deleted = self.findDeletedFiles(index, local)
+
+        # A new file with the md5 of a deleted one has been moved, no need to upload it again
+        moved = []
+        missing = dict((row[3], row) for row in deleted if row[3])
+        for f in new:
+            if ( not missing ):
+                break
+            row = missing.pop(self.md5Checksum(f[0]), None)
+            if ( row is not None ):
+                moved.append({ "from" : row[1], "to" : f[0], "photo_id" : row[0] })
+        if ( moved ):
+            movedFrom = set(move["from"] for move in moved)
+            movedTo = set(move["to"] for move in moved)
+            new = [f for f in new if f[0] not in movedTo]
+            deleted = [row for row in deleted if row[1] not in movedFrom]
+
+        changed = []
+        if ( MANAGE_CHANGES ):
+            for f in files:
+                row = index.find(f[0])
+                if ( row is not None ):
+                    fileMd5 = self.md5Checksum(f[0])
+                    if ( fileMd5 != index.md5(row) ):
+                        changed.append({ "path" : f[0], "photo_id" : int(index.ids[row]), "md5" : fileMd5, "size" : f[1] })
+
+        refused = self.tooManyDeletions(len(deleted), len(index))
+        if ( refused ):
+            deleted = []
+
+        # What createSets and addTagsToUploadedPhotos will have to do afterwards
+        gone = set(row[1] for row in deleted)
+        needSet = [f[0] for f in new]
+        needSet += [path for path in map(index.path, index.unassigned()) if path not in gone]
+        setChanges = [move["to"] for move in moved if self.setName(move["to"]) != self.setName(move["from"])]
+        needSet += setChanges
+        createdSets = set(self.setName(path) for path in needSet) - setNames
+
+        calls = {
+            "flickr.auth.checkToken"    : 2,
+            "flickr.photosets.getList"  : 1,
+            "upload"                    : len(new),
+            "replace"                   : len(changed),
+            "flickr.photos.delete"      : len(deleted),
+            "flickr.photosets.create"   : len(createdSets),
+            "flickr.photosets.addPhoto" : len(needSet) - len(createdSets),
+            "flickr.photosets.removePhoto" : len(setChanges),
+            "flickr.photos.addTags"     : len([path for path in map(index.path, index.untagged()) if path not in gone])
+        }
+        plan = {
+            "version"        : 2,
+            "created"        : time.time(),
+            "roots"          : [root.path for root in self.roots],
+            "upload"         : [{ "path" : f[0], "size" : f[1], "mtime" : f[2] } for f in new],
+            "replace"        : changed,
+            "move"           : moved,
+            "delete"         : [{ "path" : row[1], "photo_id" : row[0], "set_id" : row[2] } for row in deleted],
+            "delete_refused" : refused,
+            "bytes"          : sum(f[1] for f in new) + sum(f["size"] for f in changed),
+            "api_calls"      : calls
+        }
+        plan["estimate"] = self.estimatePlan(plan)
+        return plan
+
+    def estimatePlan( self, plan ):
+        """ Estimated run time of a plan. Bandwidth and API latencies come from
+        the last run's RUN_SUMMARY_FILE when there is one. The run can't be
+        faster than API_CALLS_PER_HOUR allows.
+        """
+        import json
+        summary = {}
+        if ( RUN_SUMMARY_FILE and os.path.exists(RUN_SUMMARY_FILE) ):
+            try:
+                summary = json.load(open(RUN_SUMMARY_FILE))
+            except ValueError:
+                pass
+        bandwidth = summary.get("bytes_per_second") or BANDWIDTH_LIMIT or PLAN_BANDWIDTH
+        if ( BANDWIDTH_LIMIT ):
+            bandwidth = min(bandwidth, BANDWIDTH_LIMIT)
+        transfer = plan["bytes"] / float(bandwidth)
+        # Upload latencies include the transfer, which is already counted
+        latencies = summary.get("api", {})
+        latency = sum(count * latencies[method]["average"] for method, count in plan["api_calls"].items() if method in latencies and method not in ("upload", "replace"))
+        rateLimit = 0
+        if ( API_CALLS_PER_HOUR > 0 ):
+            rateLimit = sum(plan["api_calls"].values()) * 3600.0 / API_CALLS_PER_HOUR
+        return {
+            "seconds"             : max(transfer + latency, rateLimit),
+            "transfer_seconds"    : transfer,
+            "api_latency_seconds" : latency,
+            "rate_limit_seconds"  : rateLimit,
+            "bandwidth"           : bandwidth,
+            "measured"            : bool(summary.get("bytes_per_second"))
+        }
+
+    def writePlan( self, path ):
+        """ --plan: report what a run would do and save the plan for --execute-plan
+        """
+        import json
+        print("*****Planning*****")
+        plan = self.makePlan()
+
+        # json can't take paths that aren't valid UTF-8, those steps get skipped
+        # by --execute-plan as their path no longer matches
+        def text( value ):
+            if ( isinstance(value, str) ):
+                return value.decode("utf-8", "replace")
+            if ( isinstance(value, dict) ):
+                return dict((text(key), text(item)) for key, item in value.items())
+            if ( isinstance(value, list) ):
+                return [text(item) for item in value]
+            return value
+
+        with open(path, "w") as f:
+            json.dump(text(plan), f, indent=2, sort_keys=True)
+        estimate = plan["estimate"]
+        print("New files:       " + str(len(plan["upload"])) + " (" + "%.1f MB" % (sum(f["size"] for f in plan["upload"]) / 1e6) + ")")
+        print("Changed files:   " + str(len(plan["replace"])) + " (" + "%.1f MB" % (sum(f["size"] for f in plan["replace"]) / 1e6) + ")")
+        print("Moved files:     " + str(len(plan["move"])))
+        if ( plan["delete_refused"] ):
+            print("Deleted files:   too many, deletion would be refused (see MAX_DELETE_RATIO)")
+        else:
+            print("Deleted files:   " + str(len(plan["delete"])))
+        print("To upload:       " + "%.1f MB" % (plan["bytes"] / 1e6))
+        print("API calls:")
+        for method, count in sorted(plan["api_calls"].items()):
+            print("   %-28s %d" % (method, count))
+        print("Estimated time:  %dh %02dm (%.2f MB/s %s)" % (estimate["seconds"] // 3600, estimate["seconds"] % 3600 // 60,
+            estimate["bandwidth"] / 1e6, "measured in the last run" if estimate["measured"] else "assumed"))
+        print("Plan written to " + path + ", run it with --execute-plan " + path)
+        print("*****Completed planning*****")
+
+    def executePlan( self ):
+        """ Carry out self.plan (--execute-plan), skipping every step that no
+        longer applies because the files changed since the plan was made
+        """
+        print("*****Executing plan*****")
+        plan = self.plan
+        encode = lambda value: value.encode("utf-8")
+
+        for entry in plan["upload"]:
+            path = encode(entry["path"])
+            if ( not os.path.isfile(path) or os.path.getsize(path) != entry["size"] or os.path.getmtime(path) != entry["mtime"] ):
+                print("Skipping " + path + ", changed since the plan was made")
+                continue
+            self.uploadFile(path)
+
+        con = self.connectDB()
+        with con:
+            cur = con.cursor()
+            for entry in plan["replace"]:
+                path = encode(entry["path"])
+                if ( not os.path.isfile(path) or self.md5Checksum(path) != entry["md5"] ):
+                    print("Skipping " + path + ", changed since the plan was made")
+                    continue
+                self.replacePhoto(path, entry["photo_id"], entry["md5"], cur, con)
+
+            for entry in plan["move"]:
+                old, path = encode(entry["from"]), encode(entry["to"])
+                cur.execute("SELECT set_id FROM files WHERE files_id = ? AND path = ?", (entry["photo_id"], old))
+                row = cur.fetchone()
+                if ( row is None or os.path.isfile(old) or not os.path.isfile(path) ):
+                    print("Skipping move of " + old + ", changed since the plan was made")
+                    continue
+                print("Moved " + old + " to " + path)
+                if ( self.setName(old) == self.setName(path) ):
+                    cur.execute("UPDATE files SET path = ? WHERE files_id = ?", (path, entry["photo_id"]))
+                    self.updateIndex("move", old, path)
+                else:
+                    # createSets adds it to the set of its new folder
+                    cur.execute("UPDATE files SET path = ?, set_id = NULL WHERE files_id = ?", (path, entry["photo_id"]))
+                    self.updateIndex("move", old, path)
+                    self.updateIndex("setSet", path, None)
+                    if ( row[0] is not None ):
+                        self.removeFileFromSet(row[0], entry["photo_id"])
+                con.commit()
+
+            deleted = []
+            for entry in plan["delete"]:
+                path = encode(entry["path"])
+                cur.execute("SELECT files_id, path, set_id FROM files WHERE files_id = ? AND path = ?", (entry["photo_id"], path))
+                row = cur.fetchone()
+                if ( row is None or os.path.isfile(path) ):
+                    print("Skipping deletion of " + path + ", changed since the plan was made")
+                    continue
+                deleted.append(row)
+            self.deleteMedia(deleted, cur)
+        print("*****Completed executing plan*****")
+
 if __name__ == "__main__":
-    # Ensure that only once instance of this script is running
-    f = open ('lock', 'w')
-    try: fcntl.lockf (f, fcntl.LOCK_EX | fcntl.LOCK_NB)
-    except IOError, e:
-        if e.errno == errno.EAGAIN:
-            sys.stderr.write('[%s] Script already running.\n' % time.strftime ('%c') )
-            sys.exit(-1)
-        raise
+    print("--------- Start time: " + time.strftime("%c") + " ---------");
     parser = argparse.ArgumentParser(description='Upload files to Flickr.')
     parser.add_argument('-d', '--daemon', action='store_true',
         help='Run forever as a daemon')
@@ -915,30 +3157,82 @@ if __name__ == "__main__":
         help='Space-separated tags for uploaded files')
     parser.add_argument('-r', '--drip-feed',   action='store_true',
         help='Wait a bit between uploading individual files')
+    parser.add_argument('-o', '--order',       action='store',
+        choices=UploadScheduler.POLICIES,
+        help='Order in which new files are uploaded (default: UPLOAD_ORDER, ' + UPLOAD_ORDER + ')')
+    parser.add_argument('-f', '--force-delete', action='store_true',
+        help='Delete files from Flickr even if more than MAX_DELETE_RATIO of them are missing')
+    parser.add_argument('-n', '--plan',        action='store', metavar='FILE',
+        help='Dry run: report what would be done, without any network call, and save the plan to FILE')
+    parser.add_argument('-x', '--execute-plan', action='store', metavar='FILE',
+        help='Carry out exactly the plan saved by --plan')
+    parser.add_argument('-p', '--profile',     action='store', metavar='DIR',
+        help='Profile each phase, writing the profiles and hot spots to DIR')
+    parser.add_argument('-c', '--config',      action='store', metavar='FILE',
+        help='Config file to use (default: ' + CONFIG_FILE + ', when it exists)')
     args = parser.parse_args()
 
-    flick = Uploadr()
-    
-    if FILES_DIR == "":
-        print("Please configure the name of the folder in the script with media available to sync with Flickr.")
+    if args.config or os.path.exists(CONFIG_FILE):
+        CONFIG_FILE = args.config or CONFIG_FILE
+        try:
+            config = Config(CONFIG_FILE)
+        except ValueError, e:
+            print(str(e))
+            sys.exit(1)
+        for warning in config.warnings:
+            print("Warning: " + warning)
+        config.apply()
+
+    if FILES_DIR == "" and not ROOTS:
+        print("Please configure the name of the folder in the script or the config file with media available to sync with Flickr.")
         sys.exit()    
 
     if FLICKR["api_key"] == "" or FLICKR["secret"] == "":
-        print("Please enter an API key and secret in the script file (see README).")
+        print("Please enter an API key and secret in the script file or the config file (see README).")
         sys.exit()
+
+    flick = Uploadr()
+    if args.profile:
+        flick.profiler = PhaseProfiler(args.profile)
         
     flick.setupDB()
 
-    if args.daemon:
-        flick.run()
-    else:
-        if ( not flick.checkToken() ):
-            flick.authenticate()
-        #flick.displaySets()
-        flick.removeUselessSetsTable()
-        flick.getFlickrSets()
-        flick.upload()
-        flick.removeDeletedMedia()
-        flick.createSets()
-        flick.addTagsToUploadedPhotos()
-print("--------- End time: " + time.strftime("%c") + " ---------");
+    # A cron run with nothing to do stops here, before anything goes over the network
+    if not (args.daemon or args.plan or args.execute_plan) and not flick.hasWork():
+        print("Nothing to do")
+        print("--------- End time: " + time.strftime("%c") + " ---------");
+        sys.exit()
+
+    # Other uploader processes may be working on the same library, work is claimed through leases in the db
+    try:
+        if args.plan:
+            flick.writePlan(args.plan)
+        elif args.daemon:
+            flick.run()
+        else:
+            if ( not flick.checkToken() ):
+                flick.authenticate()
+            #flick.displaySets()
+            flick.runPhase("removeUselessSetsTable")
+            flick.runPhase("getFlickrSets")
+            if args.execute_plan:
+                import json
+                flick.plan = json.load(open(args.execute_plan))
+                roots = [root.path for root in flick.roots]
+                if flick.plan.get("roots") != roots:
+                    print("The plan was made for " + ", ".join(flick.plan.get("roots") or [str(flick.plan.get("files_dir"))]) + ", not " + ", ".join(roots))
+                    sys.exit(1)
+                flick.runPhase("executePlan")
+            else:
+                flick.runPhase("upload", exclusive=False)
+                flick.runPhase("removeDeletedMedia")
+            flick.runPhase("createSets")
+            flick.runPhase("addTagsToUploadedPhotos")
+    finally:
+        flick.leases.releaseAll()
+        # A plan doesn't upload anything, keep the bandwidth measured by the last real run
+        if not args.plan:
+            metrics.write()
+        if flick.profiler is not None:
+            flick.profiler.write()
+        print("--------- End time: " + time.strftime("%c") + " ---------");